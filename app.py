@@ -1,32 +1,101 @@
 from db import db, User, Course, Session, Friend, Message, Major, InterestCategory, Interest
-from flask import Flask, request
+from flask import Flask, request, Response, stream_with_context, g
 import json
-from google.oauth2 import id_token
-from google.auth.transport import requests as grequests
+from functools import wraps
 from dotenv import load_dotenv
 import os
-from fetch_classes import fetch_all, fetch_classes_for_subject
+from fetch_classes import fetch_all, fetch_classes_for_subject, replay_snapshot, forget_synced
 from flask_cors import CORS
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from google_auth import GoogleTokenVerifier
+from matching import MatchEngine, MatchCache, CandidateIndex
+from serializers import shaped, USER_SHAPE, COURSE_SHAPE, SESSION_SHAPE, SCHEDULE_SHAPE
+from migrations import migrate
+from friend_graph import FriendGraph
+from inbox import record_message, unrecord_message, mark_read, list_conversations, rebuild_conversations
+from http_cache import VersionedResponseCache, cached_by
+from catalog_snapshot import CatalogSnapshot
+from sql_stats import SQLStats, N_PLUS_ONE_THRESHOLD
+from metrics import MetricsRegistry, init_app as init_metrics
+from profiler import SamplingProfiler, SAMPLE_INTERVAL, DEFAULT_PROFILE_SECONDS, MAX_PROFILE_SECONDS
+from search import CourseSearchIndex, CourseTypeahead, SEARCH_LIMIT, MAX_SEARCH_LIMIT, TYPEAHEAD_LIMIT, MAX_TYPEAHEAD_LIMIT
 
 app = Flask(__name__)
 CORS(app)
-db_filename = "cms.db"
+# Relative to the instance folder unless absolute, tests point this at a scratch file
+db_filename = os.environ.get("CMS_DB", "cms.db")
 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+# Logging every statement is slow, turn it on for local debugging only
+app.config["SQLALCHEMY_ECHO"] = os.environ.get("SQLALCHEMY_ECHO") == "1"
+# Per-request query counts and N+1 detection, see /admin/sql/
+SQL_STATS = os.environ.get("SQL_STATS") == "1"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_CHUNK = 500
+MAX_FRIEND_BATCH = 100
 
 GOOGLE_CLIENT_ID="437789147226-3b2ssaljk3jsjkijel1jlo9tapjqi2k3.apps.googleusercontent.com"
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Let readers run while the roster sync writes, and wait for locks instead of failing
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
 db.init_app(app)
+token_verifier = GoogleTokenVerifier()
+match_engine = MatchEngine()
+match_cache = MatchCache()
+candidate_index = CandidateIndex()
+course_index = CourseSearchIndex()
+course_typeahead = CourseTypeahead()
+friend_graph = FriendGraph()
+# Catalog responses, invalidated by roster syncs and course or session
+# deletes, and whenever any worker writes a new snapshot
+catalog_snapshot = CatalogSnapshot()
+catalog_cache = VersionedResponseCache(source=catalog_snapshot.generation)
+# Latency histograms and counters of every route, served at /metrics
+route_metrics = MetricsRegistry()
+init_metrics(app, route_metrics)
+# Sampling profiler started from /admin/profile/, idle until then
+profiler = SamplingProfiler()
+profiler.init_app(app)
+sql_stats = SQLStats(int(os.environ.get("SQL_N_PLUS_ONE", N_PLUS_ONE_THRESHOLD)))
 with app.app_context():
-        db.create_all()
-
-def success_response(data, code=200):
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+        if SQL_STATS:
+            sql_stats.init_app(app, db.engine)
+        migrate()
+        rebuild_conversations()
+        match_engine.build()
+        candidate_index.build()
+        friend_graph.build()
+        course_index.build()
+        course_typeahead.build()
+        # A snapshot left by an earlier run may not match this database,
+        # e.g. after it was replaced or synced by another tool
+        catalog_snapshot.write()
+
+def success_response(data, code=200, cache=None):
     """
     Return a standardized success response
+
+    data may also be a JSON body that is already encoded as bytes. Routes
+    decorated with cached_by(cache) pass the same cache here, which stores a
+    200 response and sends it with an ETag, compressed when the client accepts it
     """
-    return json.dumps(data), code
+    body = data if isinstance(data, bytes) else json.dumps(data)
+    if cache is not None and code == 200:
+        return cache.store(body, g.get("cache_version", cache.version))
+    return body, code
 
 def failure_response(data, code=404):
     """
@@ -34,13 +103,74 @@ def failure_response(data, code=404):
     """
     return json.dumps({"error": data}), code
 
-def fetch_course():
+def admin_only(view):
+    """
+    Decorator restricting a route to requests from this machine that carry
+    ADMIN_TOKEN in the X-Admin-Token header when it is set
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.remote_addr not in ("127.0.0.1", "::1"):
+            return failure_response("Forbidden", 403)
+        if ADMIN_TOKEN and request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+            return failure_response("Forbidden", 403)
+        return view(*args, **kwargs)
+    return wrapper
+
+def listing_response(query, key, serialize, cache=None):
+    """
+    Return the rows of query as a keyset paginated page or an NDJSON stream
+
+    Query parameters: limit and after_id select a page ordered by id, the
+    response carries the after_id of the next page in next_cursor.
+    format=ndjson streams one serialized row per line instead. Without any
+    of them every row is returned in one response as before. cache is
+    passed on to success_response.
+    """
+    model = query.column_descriptions[0]["entity"]
+    after_id = request.args.get("after_id", type=int)
+    limit = request.args.get("limit", type=int)
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+    query = query.order_by(model.id)
+    if request.args.get("format") == "ndjson":
+        def generate():
+            lines = []
+            for row in query.yield_per(STREAM_CHUNK):
+                lines.append(json.dumps(serialize(row)))
+                if len(lines) == STREAM_CHUNK:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+            if lines:
+                yield "\n".join(lines) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    if after_id is None and limit is None:
+        return success_response({key: [serialize(row) for row in query.all()]}, cache=cache)
+    limit = min(max(limit or PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    rows = query.limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return success_response({key: [serialize(row) for row in rows[:limit]], "next_cursor": next_cursor}, cache=cache)
+
+def fetch_course(offline=False):
     """
     Fetch course data and update the database
+
+    With offline=True the cached roster responses are replayed instead,
+    without any network access
     """
     print("Fetching start")
-    fetch_all(app)
-    return {"status": "ok"}, 200
+    if offline:
+        counts = replay_snapshot(app)
+    else:
+        counts = fetch_all(app)
+    with app.app_context():
+        course_index.build()
+        course_typeahead.build()
+        counts["snapshot"] = catalog_snapshot.write()
+    catalog_cache.bump()
+    # Course-level results were keyed to the sessions the course had before the sync
+    match_cache.clear()
+    return {"status": "ok", "counts": counts}, 200
 
 def list_of_majors():
     """
@@ -187,7 +317,7 @@ def google_login():
         token=body.get("token_id")
         if not token:
             return failure_response("Missing ID Token", 400)
-        idinfo=id_token.verify_oauth2_token(token, grequests.Request())
+        idinfo=token_verifier.verify(token)
         print("TOKEN AUD:", idinfo.get("aud"))
         print("EXPECTED:", GOOGLE_CLIENT_ID)
         if idinfo["aud"] not in [GOOGLE_CLIENT_ID]:
@@ -212,18 +342,17 @@ def google_login():
 def get_all_user():
      """
      Endpoint for getting all users
+
+     Example url:  http://127.0.0.1:8000/users/?limit=50&after_id=120
      """
-     users = []
-     for user in User.query.all():
-        users.append(user.serialize())
-     return success_response({"users": users})
+     return listing_response(shaped(User.query, USER_SHAPE), "users", User.serialize)
 
 @app.route("/users/<int:user_id>/")
 def get_user_by_id(user_id):
      """
      Endpoint for getting user by id
      """
-     user = User.query.filter_by(id=user_id).first()
+     user = shaped(User.query, USER_SHAPE).filter_by(id=user_id).first()
      if user is None:
         return failure_response("User not found!")
      return success_response(user.serialize())
@@ -251,6 +380,7 @@ def update_user(user_id):
      user = User.query.filter_by(id=user_id).first()
      if user is None:
         return failure_response("User not found!")
+     old_features = (user.major_id, {i.id for i in user.interests})
      if major:
         major_obj = Major.query.filter_by(major=major).first()
         if not major_obj:
@@ -272,11 +402,15 @@ def update_user(user_id):
             interest_obj = Interest(name=interest_name, category_id = category.id)
             db.session.add(interest_obj)
             db.session.commit()
-        interest_list.append(interest_obj)
+        if interest_obj not in interest_list:
+            interest_list.append(interest_obj)
      user.interests = interest_list
      if not profile_picture is None:
          user.profile_picture=profile_picture 
      db.session.commit()
+     if (user.major_id, {i.id for i in user.interests}) != old_features:
+        match_engine.update_user(user)
+        match_cache.invalidate_user(user.id, [s.id for s in user.sessions])
      return success_response(user.serialize(), 200)
 
 @app.route("/users/<int:user_id>/", methods=["DELETE"])
@@ -287,10 +421,25 @@ def delete_user(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("User not found!", 404)
+    session_ids = [s.id for s in user.sessions]
+    # SQLite does not enforce the foreign keys, so drop both directions here
+    Friend.query.filter((Friend.user_id == user_id) | (Friend.friend_id == user_id)).delete(synchronize_session=False)
     db.session.delete(user)
     db.session.commit()
+    match_engine.remove_user(user_id)
+    match_cache.invalidate_user(user_id, session_ids)
+    candidate_index.remove_user(user_id, session_ids)
+    friend_graph.remove_user(user_id)
     return success_response({"deleted_user": user.simple_serialize()}, 200)
 
+def profiles(user_ids):
+    """
+    Return the simple serialization of each existing user in user_ids with one query
+    """
+    if not user_ids:
+        return {}
+    return {u.id: u.simple_serialize() for u in User.query.filter(User.id.in_(user_ids))}
+
 @app.route("/users/<int:user_id>/friend/")
 def get_friends(user_id):
     """
@@ -299,14 +448,53 @@ def get_friends(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
        return failure_response("User not found!")
-    sent = Friend.query.filter_by(user_id=user_id, status="Accepted").all()
-    received = Friend.query.filter_by(friend_id=user_id, status="Accepted").all()
-    list=[]
-    for items in sent:
-        list.append(items.friend.simple_serialize())
-    for items in received:
-        list.append(items.user.simple_serialize())
-    return success_response({"friends":list}, 200)
+    friend_ids = friend_graph.friends(user_id)
+    users = profiles(friend_ids)
+    return success_response({"friends": [users[f] for f in friend_ids if f in users]}, 200)
+
+@app.route("/users/friends/")
+def get_friends_batch():
+    """
+    Endpoint for getting the friends of several users at once
+
+    Example url:  http://127.0.0.1:8000/users/friends/?ids=1,2,3
+    """
+    try:
+        user_ids = [int(i) for i in request.args.get("ids", "").split(",") if i.strip()]
+    except ValueError:
+        return failure_response("Invalid ids", 400)
+    if not user_ids or len(user_ids) > MAX_FRIEND_BATCH:
+        return failure_response("Between 1 and %d ids required" % MAX_FRIEND_BATCH, 400)
+    friends = friend_graph.friends_of(user_ids)
+    users = profiles(sorted({f for ids in friends.values() for f in ids}))
+    return success_response({"friends": {
+        user_id: [users[f] for f in ids if f in users] for user_id, ids in friends.items()
+    }}, 200)
+
+@app.route("/users/<int:user_id>/friend/requests/")
+def get_friend_requests(user_id):
+    """
+    Endpoint for getting the pending friend requests a user received and sent
+    """
+    user = User.query.filter_by(id=user_id).first()
+    if user is None:
+       return failure_response("User not found!")
+    pending = friend_graph.requests(user_id)
+    users = profiles(pending["incoming"] + pending["outgoing"])
+    return success_response({
+        direction: [users[u] for u in ids if u in users] for direction, ids in pending.items()
+    }, 200)
+
+@app.route("/users/<int:user_id>/friend/<int:friend_id>/")
+def get_friendship_status(user_id, friend_id):
+    """
+    Endpoint for checking whether two users are friends
+
+    status is "Accepted", "Incoming" or "Outgoing" from the point of view of
+    user_id, or null when there is no friendship or request
+    """
+    status = friend_graph.status(user_id, friend_id)
+    return success_response({"user_id": user_id, "friend_id": friend_id, "status": status}, 200)
 
 @app.route("/users/<int:user_id>/friend/<int:friend_id>/", methods=["POST"])
 def send_friend_request(user_id, friend_id):
@@ -317,15 +505,16 @@ def send_friend_request(user_id, friend_id):
     friend = User.query.filter_by(id=friend_id).first()
     if not user or not friend:
         return failure_response("User not found", 404)
-    current = Friend.query.filter(
-        ((Friend.user_id==user_id) & (Friend.friend_id==friend_id)) | 
-        ((Friend.user_id==friend_id) & (Friend.friend_id==user_id))
-    ).first()
-    if not current is None:
-        return failure_response("Friendship already exists", 400)
+    # The unique pair key rejects a second request for the same pair in
+    # either direction, even when two requests race
     new = Friend(user_id=user_id, friend_id=friend_id, status="Pending")
     db.session.add(new)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return failure_response("Friendship already exists", 400)
+    friend_graph.add_request(user_id, friend_id)
     return success_response(new.serialize(), 201)
     
 @app.route("/users/<int:user_id>/friends/<int:friend_id>/", methods=["POST"])
@@ -342,19 +531,18 @@ def respond_request(user_id, friend_id):
     action = body.get("action")
     if action not in ["accept","reject"]:
         return failure_response("Invalid action", 400)
-    current = Friend.query.filter(
-        ((Friend.user_id==user_id) & (Friend.friend_id==friend_id)) | 
-        ((Friend.user_id==friend_id) & (Friend.friend_id==user_id))
-    ).first()
+    current = Friend.find_pair(user_id, friend_id)
     if not current:
         return failure_response("Friendship not found", 404)
     if action=="accept":
         current.status = "Accepted"
         db.session.commit()
+        friend_graph.accept(current.user_id, current.friend_id)
         return success_response(current.serialize(), 201)
     else:
         db.session.delete(current)
         db.session.commit()
+        friend_graph.remove(user_id, friend_id)
         return success_response({"Friend request rejected"}, 200)
     
 @app.route("/users/<int:user_id>/<int:friend_id>/", methods=["DELETE"])
@@ -362,36 +550,49 @@ def delete_friend(user_id, friend_id):
     """
     Endpoint for removing user by ID
     """
-    friendship = Friend.query.filter(
-            ((Friend.user_id == user_id) & (Friend.friend_id == friend_id)) |
-            ((Friend.user_id == friend_id) & (Friend.friend_id == user_id))
-                ).first()
+    friendship = Friend.find_pair(user_id, friend_id)
     if not friendship:
             return failure_response("Friendship not found!", 404)
     db.session.delete(friendship)
     db.session.commit()
+    friend_graph.remove(user_id, friend_id)
     return success_response(friendship.serialize(), 200)
   
 # ------------------- COURSE ROUTES -------------------
 @app.route("/courses/")
+@cached_by(catalog_cache)
 def get_courses():
     """
     Endpoint to get all the courses
+
+    Example url:  http://127.0.0.1:8000/courses/?limit=50&after_id=120
     """
-    courses = []
-    for course in Course.query.all():
-        courses.append(course.simple_serialize())
-    return success_response({"courses": courses})
+    snapshot = catalog_snapshot.current()
+    if snapshot is not None and request.args.get("format") != "ndjson":
+        after_id = request.args.get("after_id", type=int)
+        limit = request.args.get("limit", type=int)
+        if after_id is None and limit is None:
+            return success_response(snapshot.course_list(), cache=catalog_cache)
+        limit = min(max(limit or PAGE_SIZE, 1), MAX_PAGE_SIZE)
+        return success_response(snapshot.course_page(after_id, limit), cache=catalog_cache)
+    return listing_response(Course.query, "courses", Course.simple_serialize, cache=catalog_cache)
 
 @app.route("/courses/<int:course_id>/")
+@cached_by(catalog_cache)
 def get_course_by_id(course_id):
     """
     Endpoint to get a course by id
     """
-    course = Course.query.filter_by(id=course_id).first()
+    snapshot = catalog_snapshot.current()
+    if snapshot is not None:
+        body = snapshot.course(course_id)
+        if body is None:
+            return failure_response("Course not found", 404)
+        return success_response(body, cache=catalog_cache)
+    course = shaped(Course.query, COURSE_SHAPE).filter_by(id=course_id).first()
     if not course:
         return failure_response("Course not found", 404)
-    return success_response(course.serialize())
+    return success_response(course.serialize(), cache=catalog_cache)
 
 @app.route("/courses/<int:course_id>/", methods=["DELETE"])
 def delete_course(course_id):
@@ -401,17 +602,46 @@ def delete_course(course_id):
     course = Course.query.filter_by(id=course_id).first()
     if not course:
         return failure_response("Course not found", 404)
+    session_ids = [s.id for s in course.sessions]
     db.session.delete(course)
+    # The next roster sync restores the course
+    forget_synced()
     db.session.commit()
+    match_cache.invalidate_sessions(session_ids)
+    candidate_index.remove_sessions(session_ids)
+    course_index.discard(course_id)
+    course_typeahead.discard(course_id)
+    catalog_snapshot.write()
+    catalog_cache.bump()
     return success_response(course.serialize(), 200)
 
+@app.route("/courses/<int:course_id>/students/")
+def get_course_students(course_id):
+    """
+    Endpoint to get every user enrolled in a session of the course
+    """
+    course = Course.query.filter_by(id=course_id).first()
+    if not course:
+        return failure_response("Course not found", 404)
+    student_ids = candidate_index.students_in_course(course_id).tolist()
+    students = User.query.filter(User.id.in_(student_ids)).order_by(User.id).all()
+    return success_response({"students": [s.simple_serialize() for s in students]}, 200)
+
 # ------------------- SESSION ROUTES -------------------
 @app.route("/session/<int:session_id>/")
 def get_sessions(session_id):
     """
     Endpoint to get a session by id
     """
-    session = Session.query.filter_by(id=session_id).first()
+    snapshot = catalog_snapshot.current()
+    if snapshot is not None:
+        body = snapshot.session(session_id)
+        if body is None:
+            return failure_response("Session not found", 404)
+        student_ids = candidate_index.students_in_sessions([session_id]).tolist()
+        students = User.query.filter(User.id.in_(student_ids)).order_by(User.id).all() if student_ids else []
+        return success_response(body + json.dumps([s.simple_serialize() for s in students]).encode() + b"}")
+    session = shaped(Session.query, SESSION_SHAPE).filter_by(id=session_id).first()
     if not session:
         return failure_response("Session not found", 404)
     return success_response(session.serialize())
@@ -424,9 +654,15 @@ def delete_session(session_id):
     session = Session.query.filter_by(id=session_id).first()
     if not session:
         return failure_response("Session not found", 404)
+    result = session.serialize()
     db.session.delete(session)
+    forget_synced()
     db.session.commit()
-    return success_response(session.serialize(), 200)
+    match_cache.invalidate_sessions([session_id])
+    candidate_index.remove_sessions([session_id])
+    catalog_snapshot.write()
+    catalog_cache.bump()
+    return success_response(result, 200)
 
 # ------------------- SCHEDULE ROUTES -------------------
 @app.route("/users/<int:user_id>/schedule/")
@@ -434,7 +670,7 @@ def get_user_schedule(user_id):
     """
     Endpoint to get all sessions from a user's schedule
     """
-    user=User.query.filter_by(id=user_id).first()
+    user=shaped(User.query, SCHEDULE_SHAPE).filter_by(id=user_id).first()
     if not user:
         return failure_response("User not found", 404)
     list= [s.serialize() for s in user.sessions]
@@ -455,6 +691,8 @@ def add_session_to_schedule(user_id, session_id):
         return failure_response("Session already in schedule", 400)
     user.sessions.append(session)
     db.session.commit()
+    match_cache.invalidate_sessions([session_id])
+    candidate_index.add(user_id, session_id, session.course_id)
     return success_response(user.serialize(), 201)
 
 @app.route("/users/<int:user_id>/schedule/<int:session_id>/", methods=["DELETE"])
@@ -473,6 +711,8 @@ def remove_session_from_schedule(user_id, session_id):
     if session in user.sessions:
         user.sessions.remove(session)
         db.session.commit()
+        match_cache.invalidate_sessions([session_id])
+        candidate_index.remove(user_id, session_id)
     return success_response(user.serialize(), 200)
 
 # ------------------- MESSAGE ROUTES -------------------
@@ -493,6 +733,8 @@ def send_message():
         return failure_response("User not found", 404)
     message = Message(sender_id=sender_id,receiver_id=receiver_id,content=content)
     db.session.add(message)
+    db.session.flush()
+    record_message(message)
     db.session.commit()
     return success_response(message.serialize(), 201)
 
@@ -500,38 +742,84 @@ def send_message():
 def get_conversation(user_id, friend_id):
     """
     Endpoint that get the conversation between two users
+
+    Example url:  http://127.0.0.1:8000/messages/1/2/?limit=50&before_id=812
+
+    With limit, before_id or after_id the messages are returned newest first
+    one page at a time. before_id pages towards older messages, after_id
+    towards newer ones, and next_cursor is the id to pass as the same
+    parameter to get the next page
     """
     user=User.query.filter_by(id=user_id).first()
     friend=User.query.filter_by(id=friend_id).first()
     if not user or not friend:
         return failure_response("User not found", 404)
-    messages = Message.query.filter(
-        ((Message.sender_id == user_id) & (Message.receiver_id == friend_id)) |
-        ((Message.sender_id == friend_id) & (Message.receiver_id == user_id))
-    ).order_by(Message.sent_at).all()
-    return success_response({"messages": [m.simple_serialize() for m in messages]}, 200)
+    limit = request.args.get("limit", type=int)
+    before_id = request.args.get("before_id", type=int)
+    after_id = request.args.get("after_id", type=int)
+    if limit is None and before_id is None and after_id is None:
+        messages = Message.query.filter(
+            ((Message.sender_id == user_id) & (Message.receiver_id == friend_id)) |
+            ((Message.sender_id == friend_id) & (Message.receiver_id == user_id))
+        ).order_by(Message.sent_at).all()
+        return success_response({"messages": [m.simple_serialize() for m in messages]}, 200)
+    limit = min(max(limit or PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    newer = after_id is not None
+    cursor = None
+    if before_id is not None or after_id is not None:
+        cursor = Message.query.filter_by(id=after_id if newer else before_id).first()
+        if not cursor or {cursor.sender_id, cursor.receiver_id} != {user_id, friend_id}:
+            return failure_response("Invalid cursor", 400)
+    # Pages are keyed on the id, which grows with every message. sent_at is
+    # not a usable key: the database default stores it without microseconds,
+    # so it neither compares equal to a bound datetime nor breaks ties.
+    # Each direction is one range scan of the (sender_id, receiver_id, id)
+    # index, the two pages are merged here
+    messages = []
+    for sender, receiver in {(user_id, friend_id), (friend_id, user_id)}:
+        q = Message.query.filter_by(sender_id=sender, receiver_id=receiver)
+        if newer:
+            q = q.filter(Message.id > cursor.id).order_by(Message.id.asc())
+        else:
+            if cursor:
+                q = q.filter(Message.id < cursor.id)
+            q = q.order_by(Message.id.desc())
+        messages.extend(q.limit(limit + 1).all())
+    messages.sort(key=lambda m: m.id, reverse=not newer)
+    more = len(messages) > limit
+    messages = messages[:limit]
+    if newer:
+        messages.reverse()
+        next_cursor = messages[0].id if more else None
+    else:
+        next_cursor = messages[-1].id if more else None
+    return success_response({"messages": [{"id": m.id, **m.simple_serialize()} for m in messages], "next_cursor": next_cursor}, 200)
 
 @app.route("/messages/<int:user_id>/conversations/")
 def get_inbox_preview(user_id):
     """
-    Endpoint that get the latest message from each conversation for a user
+    Endpoint that get the latest message and unread count of each conversation for a user
     """
     user=User.query.filter_by(id=user_id).first()
     if not user:
         return failure_response("User not found", 404)
-    messages = Message.query.filter(
-        (Message.sender_id==user_id)|(Message.receiver_id==user_id)
-    ).order_by(Message.sent_at.desc()).all()
     conversations = {}
-    for items in messages:
-        if items.sender_id==user_id:
-            friend_id=items.receiver_id
-        else:
-            friend_id=items.sender_id
-        if friend_id not in conversations:
-            conversations[friend_id]=items.simple_serialize()
+    for conversation in list_conversations(user_id):
+        friend_id = conversation.user_b_id if conversation.user_a_id == user_id else conversation.user_a_id
+        conversations[friend_id] = conversation.serialize_for(user_id)
     return success_response({"conversations": conversations}, 200)
 
+@app.route("/messages/<int:user_id>/conversations/<int:friend_id>/read/", methods=["POST"])
+def read_conversation(user_id, friend_id):
+    """
+    Endpoint that marks the messages a user received from a friend as read
+    """
+    conversation = mark_read(user_id, friend_id)
+    if not conversation:
+        return failure_response("Conversation not found", 404)
+    db.session.commit()
+    return success_response(conversation.serialize_for(user_id), 200)
+
 @app.route("/messages/<int:message_id>/", methods=["DELETE"])
 def delete_message(message_id):
     """
@@ -541,6 +829,7 @@ def delete_message(message_id):
     if not message:
         return failure_response("Message not found", 404)
     result = message.serialize()
+    unrecord_message(message)
     db.session.delete(message)
     db.session.commit()
     return success_response(result, 200)
@@ -549,18 +838,29 @@ def delete_message(message_id):
 @app.route("/courses/search/")
 def search_courses():
     """
-    Endpoint to get a list of courses based on a query string
+    Endpoint to get a relevance ranked list of courses based on a query string
 
-    Example url:  http://127.0.0.1:8000/courses/search/?q=math
+    Example url:  http://127.0.0.1:8000/courses/search/?q=math&limit=20
     """
     query = request.args.get("q","")
     query = query.strip()
+    limit = min(max(request.args.get("limit", SEARCH_LIMIT, type=int), 1), MAX_SEARCH_LIMIT)
     if len(query)<3:
         return success_response({"courses":[], "sessions":[]})
-    courses = Course.query.filter(
-        (Course.code.ilike(f"%{query}%"))|(Course.name.ilike(f"%{query}%"))
-    ).all()
-    return success_response({"courses":[c.simple_serialize() for c in courses]}, 200)
+    courses = course_index.search(query, limit)
+    return success_response({"courses":[{"id": i, "code": code, "name": name} for i, code, name in courses]}, 200)
+
+@app.route("/courses/autocomplete/")
+def autocomplete_courses():
+    """
+    Endpoint to get the most enrolled courses whose code or title starts with a prefix
+
+    Example url:  http://127.0.0.1:8000/courses/autocomplete/?q=cs&limit=10
+    """
+    query = request.args.get("q","").strip()
+    limit = min(max(request.args.get("limit", TYPEAHEAD_LIMIT, type=int), 1), MAX_TYPEAHEAD_LIMIT)
+    courses = course_typeahead.complete(query, limit)
+    return success_response({"courses":[{"id": i, "code": code, "name": name} for i, code, name in courses]}, 200)
 
 @app.route("/users/<int:user_id>/match/", methods=["POST"])
 def match_buddy(user_id):
@@ -578,6 +878,11 @@ def match_buddy(user_id):
     session_ids = body.get("session_ids",[])
     if not code:
         return failure_response("Invalid body information", 400)
+    key = match_cache.key(user_id, code, session_ids)
+    cached = match_cache.get(key)
+    if cached is not None:
+        return success_response({"matches": cached}, 200)
+    generation = match_cache.generation
     user = User.query.filter_by(id=user_id).first()
     if not user:
         return failure_response("User not found", 404)
@@ -585,40 +890,116 @@ def match_buddy(user_id):
     if not course:
         return failure_response("Course not found", 404)
     if session_ids:
-        sessions = Session.query.filter(Session.id.in_(session_ids)).all()
+        sessions = db.session.query(Session.id).filter(Session.id.in_(session_ids))
     else:
-        session_ids= [s.id for s in course.sessions]
-        sessions = Session.query.filter(Session.id.in_(session_ids)).all()
-    if not sessions:
+        sessions = db.session.query(Session.id).filter_by(course_id=course.id)
+    session_ids = [s.id for s in sessions]
+    if not session_ids:
         return failure_response("Session not found", 404)
-    potential=[]
-    for s in sessions:
-        for student in s.students:
-            if student.id!=user.id and student not in potential:
-                potential.append(student)
-
-    user_major_id = user.major.id if user.major else None
-    user_interest_ids = {i.id for i in user.interests}
-    user_category_ids = {i.category_id for i in user.interests}
+    potential = candidate_index.students_in_sessions(session_ids)
+    potential = potential[potential != user.id]
 
+    ranked = match_engine.top_matches(user.id, potential)
+    buddies = {u.id: u for u in User.query.filter(User.id.in_([b for b, _ in ranked]))}
     matches=[]
-
-    for buddy in potential:
-        score=0
-        if user_major_id and buddy.major and buddy.major.id == user_major_id:
-            score+=30
-        buddy_interests = buddy.interests
-        buddy_interest_ids = {i.id for i in buddy_interests}
-        buddy_category_ids = {i.category_id for i in buddy_interests}
-        common_interests = user_interest_ids.intersection(buddy_interest_ids)
-        score+=15*len(common_interests)
-        common_categories = user_category_ids.intersection(buddy_category_ids)
-        category_bonus = max(0, len(common_categories)-len(common_interests))
-        score+=5*category_bonus
-        matches.append({"student": buddy.simple_serialize(), "score": score})
-    
-    matches.sort(key=lambda x: x["score"], reverse=True)
-    return success_response({"matches": matches[:10]}, 200)    
+    for buddy_id, score in ranked:
+        # The index can briefly list a user that was just deleted
+        if buddy_id not in buddies:
+            continue
+        matches.append({"student": buddies[buddy_id].simple_serialize(), "score": score})
+    match_cache.put(key, session_ids, matches, generation)
+    return success_response({"matches": matches}, 200)
+
+@app.route("/match/cache/")
+def get_match_cache_stats():
+    """
+    Endpoint that returns the size and hit/miss counters of the match result cache
+    """
+    return success_response(match_cache.stats(), 200)
+
+@app.route("/courses/snapshot/")
+def get_catalog_snapshot_stats():
+    """
+    Endpoint that returns the size, generation time and request count of the catalog snapshot
+    """
+    return success_response(catalog_snapshot.stats(), 200)
+
+@app.route("/courses/cache/")
+def get_catalog_cache_stats():
+    """
+    Endpoint that returns the version and hit counters of the catalog response cache
+    """
+    return success_response(catalog_cache.stats(), 200)
+
+@app.route("/metrics")
+def get_metrics():
+    """
+    Endpoint that returns route latency histograms, p50/p95/p99 and request counters in Prometheus format
+    """
+    return route_metrics.response()
+
+# ------------------- ADMIN ROUTES -------------------
+@app.route("/admin/sql/", methods=["GET", "DELETE"])
+@admin_only
+def get_sql_stats():
+    """
+    Endpoint that returns the SQL query count, time, slowest statement and
+    N+1 findings of each endpoint, DELETE clears them. Needs SQL_STATS=1
+    """
+    if not SQL_STATS:
+        return failure_response("SQL instrumentation is off, start with SQL_STATS=1", 404)
+    if request.method == "DELETE":
+        sql_stats.reset()
+    return success_response(sql_stats.report(), 200)
+
+@app.route("/admin/profile/", methods=["GET", "POST", "DELETE"])
+@admin_only
+def profile():
+    """
+    Endpoint that runs the sampling profiler. POST starts it with optional
+    seconds, requests, endpoint and interval_ms, and with wait also blocks
+    until it ends and returns the collapsed stacks. GET returns its status,
+    DELETE stops it. Needs ADMIN_TOKEN
+    """
+    if not ADMIN_TOKEN:
+        return failure_response("The profiler is off, start with ADMIN_TOKEN set", 404)
+    if request.method == "DELETE":
+        profiler.stop()
+        profiler.wait(1)
+    if request.method != "POST":
+        return success_response(profiler.status(), 200)
+    body = request.get_json(silent=True) or {}
+    try:
+        seconds = float(body.get("seconds", DEFAULT_PROFILE_SECONDS))
+        limit = body.get("requests")
+        limit = int(limit) if limit is not None else None
+        interval = float(body.get("interval_ms", SAMPLE_INTERVAL * 1000)) / 1000
+    except (TypeError, ValueError):
+        return failure_response("seconds, requests and interval_ms must be numbers", 400)
+    if seconds <= 0 or seconds > MAX_PROFILE_SECONDS or (limit is not None and limit <= 0):
+        return failure_response("seconds must be between 0 and %d, requests positive" % MAX_PROFILE_SECONDS, 400)
+    endpoint = body.get("endpoint")
+    if endpoint is not None and endpoint not in app.view_functions:
+        return failure_response("Unknown endpoint", 400)
+    if not profiler.start(seconds, limit, endpoint, interval):
+        return failure_response("A profile is already running", 409)
+    if not body.get("wait"):
+        return success_response(profiler.status(), 201)
+    profiler.wait()
+    return get_profile_stacks()
+
+@app.route("/admin/profile/stacks/")
+@admin_only
+def get_profile_stacks():
+    """
+    Endpoint that returns the samples of the last profile as collapsed stacks,
+    ready for flamegraph.pl or speedscope. Needs ADMIN_TOKEN
+    """
+    if not ADMIN_TOKEN:
+        return failure_response("The profiler is off, start with ADMIN_TOKEN set", 404)
+    response = Response(profiler.collapsed(), mimetype="text/plain")
+    response.headers["Content-Disposition"] = "attachment; filename=profile.folded"
+    return response
 
 
 if __name__ == "__main__":
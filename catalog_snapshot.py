@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import threading
+import numpy as np
+from db import db, Course, Session
+from serializers import shaped, COURSE_SHAPE
+
+SNAPSHOT_FILE = "catalog.snapshot"
+SNAPSHOT_MAGIC = b"CATSNAP1"
+# magic, course count, session count, offset and length of the course list
+HEADER = struct.Struct("<8sQQQQ")
+# Rows of the course index: id, offset and length of simple_serialize(), of serialize()
+COURSE_FIELDS = 5
+# Rows of the session index: id, offset and length of the serialized session without students
+SESSION_FIELDS = 3
+# Seconds between checks whether another process wrote a newer snapshot
+SNAPSHOT_CHECK_INTERVAL = 1
+
+def default_path():
+    """
+    Returns the snapshot path, CATALOG_SNAPSHOT or a file next to the database, must run inside an app context
+    """
+    return os.environ.get("CATALOG_SNAPSHOT") or os.path.join(
+        os.path.dirname(db.engine.url.database), SNAPSHOT_FILE
+    )
+
+class SnapshotView:
+    """
+    One memory-mapped snapshot file. The indexes are numpy views of the
+    mapping, so every process reading the file shares the same pages
+    """
+    def __init__(self, path):
+        """
+        Maps the snapshot at path and checks its header
+        """
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, courses, sessions, list_offset, list_length = HEADER.unpack_from(self.data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a catalog snapshot: %s" % path)
+        offset = HEADER.size
+        self.courses = np.frombuffer(self.data, dtype=np.int64, count=courses * COURSE_FIELDS, offset=offset).reshape(-1, COURSE_FIELDS)
+        offset += self.courses.nbytes
+        self.sessions = np.frombuffer(self.data, dtype=np.int64, count=sessions * SESSION_FIELDS, offset=offset).reshape(-1, SESSION_FIELDS)
+        self.course_ids = self.courses[:, 0]
+        self.session_ids = self.sessions[:, 0]
+        self.list_offset = list_offset
+        self.list_length = list_length
+        self.size = self.stat.st_size
+
+    def find(self, ids, key):
+        """
+        Returns the row of key in a sorted id column, or None
+        """
+        i = int(np.searchsorted(ids, key))
+        if i < len(ids) and ids[i] == key:
+            return i
+        return None
+
+    def course_list(self):
+        """
+        Returns the JSON body of /courses/ without paging
+        """
+        return self.data[self.list_offset:self.list_offset + self.list_length]
+
+    def course_page(self, after_id, limit):
+        """
+        Returns the JSON body of the /courses/ page of up to limit courses after after_id
+        """
+        start = 0 if after_id is None else int(np.searchsorted(self.course_ids, after_id, side="right"))
+        end = min(start + limit, len(self.course_ids))
+        if start < end:
+            # The simple courses are stored in id order separated by ", ", so
+            # a page is one contiguous slice
+            first = self.courses[start, 1]
+            last = self.courses[end - 1, 1] + self.courses[end - 1, 2]
+            items = self.data[first:last]
+        else:
+            items = b""
+        more = end < len(self.course_ids)
+        next_cursor = int(self.course_ids[end - 1]) if more and end > start else None
+        return b'{"courses": [' + items + b'], "next_cursor": ' + json.dumps(next_cursor).encode() + b"}"
+
+    def course(self, course_id):
+        """
+        Returns the JSON body of /courses/<course_id>/, or None if there is no such course
+        """
+        i = self.find(self.course_ids, course_id)
+        if i is None:
+            return None
+        offset, length = self.courses[i, 3], self.courses[i, 4]
+        return self.data[offset:offset + length]
+
+    def session(self, session_id):
+        """
+        Returns the serialized session up to and including the "students" key,
+        the caller appends the student list and the closing brace. None if there is no such session
+        """
+        i = self.find(self.session_ids, session_id)
+        if i is None:
+            return None
+        offset, length = self.sessions[i, 1], self.sessions[i, 2]
+        return self.data[offset:offset + length]
+
+
+class CatalogSnapshot:
+    """
+    Immutable file holding the serialized course and session catalog with an
+    offset index by id, rewritten after each roster sync and shared by all
+    workers through mmap
+    """
+    def __init__(self, path=None):
+        """
+        Initializes a reader of the snapshot at path, default_path() if None
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.view = None
+        self.checked = 0
+        self.info = {}
+        self.served = 0
+
+    def resolve(self):
+        """
+        Returns the snapshot path, must run inside an app context the first time
+        """
+        if self.path is None:
+            self.path = default_path()
+        return self.path
+
+    def write(self):
+        """
+        Serializes the catalog into a new snapshot, atomically replaces the
+        old one and maps it. Must run inside an app context. Returns the
+        course and session counts, file size and generation time
+        """
+        start = time.perf_counter()
+        path = self.resolve()
+        courses = shaped(Course.query, COURSE_SHAPE).order_by(Course.id).all()
+        sessions = Session.query.order_by(Session.id).all()
+        course_names = {c.id: c.simple_serialize() for c in courses}
+        blob = bytearray()
+        course_rows = []
+        blob += b'{"courses": ['
+        for i, course in enumerate(courses):
+            if i:
+                blob += b", "
+            item = json.dumps(course_names[course.id]).encode()
+            course_rows.append([course.id, len(blob), len(item), 0, 0])
+            blob += item
+        blob += b"]}"
+        list_length = len(blob)
+        for row, course in zip(course_rows, courses):
+            body = json.dumps(course.serialize()).encode()
+            row[3], row[4] = len(blob), len(body)
+            blob += body
+        session_rows = []
+        for session in sessions:
+            if session.course_id not in course_names:
+                continue
+            # Same keys in the same order as Session.serialize(), students are added per request
+            body = json.dumps(dict(session.simple_serialize(), course=course_names[session.course_id]))
+            body = (body[:-1] + ', "students": ').encode()
+            session_rows.append([session.id, len(blob), len(body)])
+            blob += body
+        db.session.rollback()
+        course_index = np.array(course_rows, dtype=np.int64).reshape(-1, COURSE_FIELDS)
+        session_index = np.array(session_rows, dtype=np.int64).reshape(-1, SESSION_FIELDS)
+        data_offset = HEADER.size + course_index.nbytes + session_index.nbytes
+        course_index[:, [1, 3]] += data_offset
+        session_index[:, 1] += data_offset
+        header = HEADER.pack(SNAPSHOT_MAGIC, len(course_rows), len(session_rows), data_offset, list_length)
+        temp = path + ".tmp%d" % os.getpid()
+        with open(temp, "wb") as f:
+            f.write(header)
+            f.write(course_index.tobytes())
+            f.write(session_index.tobytes())
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+        view = SnapshotView(path)
+        info = {
+            "courses": len(course_rows),
+            "sessions": len(session_rows),
+            "bytes": view.size,
+            "seconds": round(time.perf_counter() - start, 4)
+        }
+        with self.lock:
+            self.view = view
+            self.checked = time.monotonic()
+            self.info = info
+        print("Wrote catalog snapshot", info)
+        return info
+
+    def latest(self):
+        """
+        Returns the SnapshotView of the newest snapshot file, or None when
+        there is none. Files written by other processes are picked up within
+        SNAPSHOT_CHECK_INTERVAL seconds
+        """
+        now = time.monotonic()
+        with self.lock:
+            view = self.view
+            if view is not None and now - self.checked < SNAPSHOT_CHECK_INTERVAL:
+                return view
+            self.checked = now
+        path = self.resolve()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if view is None or (stat.st_ino, stat.st_mtime_ns) != (view.stat.st_ino, view.stat.st_mtime_ns):
+            view = SnapshotView(path)
+        with self.lock:
+            self.view = view
+        return view
+
+    def current(self):
+        """
+        Returns latest() for serving a request, counting it
+        """
+        view = self.latest()
+        if view is not None:
+            with self.lock:
+                self.served += 1
+        return view
+
+    def generation(self):
+        """
+        Returns the inode and mtime of the newest snapshot file, which change
+        with every write by any process, or None when there is none
+        """
+        view = self.latest()
+        if view is None:
+            return None
+        return (view.stat.st_ino, view.stat.st_mtime_ns)
+
+    def stats(self):
+        """
+        Returns the last generation report, the mapped file size and the number of requests served
+        """
+        with self.lock:
+            return {
+                "path": self.path,
+                "bytes": self.view.size if self.view is not None else 0,
+                "served": self.served,
+                "last_write": self.info
+            }
+
+
+def benchmark(requests=200):
+    """
+    Writes a snapshot of the app database and compares per-request latency
+    of the catalog routes served from it and from the ORM
+    """
+    import app as service
+    service.app.config["SQLALCHEMY_ECHO"] = False
+    client = service.app.test_client()
+    with service.app.app_context():
+        info = service.catalog_snapshot.write()
+        course_id = db.session.query(Course.id).order_by(Course.id).limit(1).scalar()
+        session_id = db.session.query(Session.id).order_by(Session.id).limit(1).scalar()
+    print("snapshot: %d courses, %d sessions, %d bytes, written in %.3fs" % (
+        info["courses"], info["sessions"], info["bytes"], info["seconds"]))
+    urls = ["/courses/", "/courses/?limit=50"]
+    if course_id is not None:
+        urls.append("/courses/%d/" % course_id)
+    if session_id is not None:
+        urls.append("/session/%d/" % session_id)
+    path = service.catalog_snapshot.path
+    for url in urls:
+        timings = {}
+        for source in ["orm", "snapshot"]:
+            # Without a snapshot file the routes fall back to the ORM
+            service.catalog_snapshot.view = None
+            service.catalog_snapshot.path = path if source == "snapshot" else path + ".missing"
+            elapsed = []
+            for _ in range(requests):
+                # Skip the response cache so every request does the work
+                service.catalog_cache.bump()
+                start = time.perf_counter()
+                client.get(url)
+                elapsed.append(time.perf_counter() - start)
+            elapsed.sort()
+            timings[source] = (elapsed[len(elapsed) // 2] * 1000, elapsed[int(len(elapsed) * 0.99)] * 1000)
+        print("%-24s orm p50=%.3fms p99=%.3fms  snapshot p50=%.3fms p99=%.3fms" % (
+            url, timings["orm"][0], timings["orm"][1], timings["snapshot"][0], timings["snapshot"][1]))
+    service.catalog_snapshot.path = path
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
@@ -7,12 +7,24 @@ import threading
 
 BASE_URL = "http://127.0.0.1:5000"
 WS_URL = "ws://127.0.0.1:5000/ws"
+HISTORY_PAGE_SIZE = 20
 
 def format_str(msg):
     if isinstance(msg, str):
         msg = json.loads(msg)
     return f"({datetime.fromisoformat(msg['timestamp']):%d-%m-%Y %H:%M:%S}) [{msg['sent_by']}] {msg['message']}"
 
+def load_page(user_id, other_id, before_id=None):
+    params = {"user_1_id": user_id, "user_2_id": other_id, "limit": HISTORY_PAGE_SIZE}
+    if before_id:
+        params["before_id"] = before_id
+    r = requests.get(BASE_URL + "/messages/history", params=params)
+    page = r.json()
+    # pages come newest first, print them oldest first
+    for msg in reversed(page["messages"]):
+        print(format_str(msg))
+    return page["next_cursor"]
+
 def listen(ws):
     while True:
         try:
@@ -27,20 +39,14 @@ def main():
     other_id = input("Enter the user id you want to chat with: ")
 
     print("Loading chat history...")
-    r = requests.get(BASE_URL + "/messages/history", params={
-        "user_1_id": user_id,
-        "user_2_id": other_id
-    })
-    # print(json.dumps(r.json(), indent=2))
-    for msg in r.json():
-        print(format_str(msg))
+    older = load_page(user_id, other_id)
 
     ws = websocket.create_connection(WS_URL)
     ws.send(json.dumps({"user_id": user_id}))
 
     threading.Thread(target=listen, args=(ws,), daemon=True).start()
 
-    print("Type messages, or /delete <id>, or /quit")
+    print("Type messages, or /older, or /delete <id>, or /quit")
 
     while True:
         text = input("> ")
@@ -49,6 +55,13 @@ def main():
             ws.close()
             break
 
+        if text == "/older":
+            if older:
+                older = load_page(user_id, other_id, older)
+            else:
+                print("No older messages")
+            continue
+
         if text.startswith("/delete"):
             _, mid = text.split()
             ws.send(json.dumps({
@@ -5,15 +5,17 @@ db = SQLAlchemy()
 user_session_table = db.Table(
     "user_session_association",
     db.Model.metadata,
-    db.Column("session_id", db.Integer, db.ForeignKey("sessions.id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("users.id"))
+    db.Column("session_id", db.Integer, db.ForeignKey("sessions.id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+    db.Index("ix_user_session_user_session", "user_id", "session_id")
 )
 
 user_interest_table = db.Table(
     "user_interest_association",
     db.Model.metadata,
-    db.Column("user_id", db.Integer, db.ForeignKey("users.id")),
-    db.Column("interest_id", db.Integer, db.ForeignKey("interests.id"))
+    db.Column("user_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+    db.Column("interest_id", db.Integer, db.ForeignKey("interests.id"), primary_key=True),
+    db.Index("ix_user_interest_interest_user", "interest_id", "user_id")
 )
 
 class User(db.Model):
@@ -127,6 +129,9 @@ class Session(db.Model):
     time = db.Column(db.String)
     course = db.relationship("Course", back_populates="sessions")
     students=db.relationship("User",secondary=user_session_table, back_populates="sessions", passive_deletes=True)
+    __table_args__ = (
+        db.Index("ix_sessions_course_id", "course_id"),
+    )
 
     def __init__(self,**kwargs):
         """
@@ -171,8 +176,23 @@ class Friend(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     friend_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     status = db.Column(db.String, default = 'Pending', nullable=False)
+    # The two user ids in ascending order, one row per pair whoever sent the request
+    pair_low = db.Column(db.Integer, nullable=False)
+    pair_high = db.Column(db.Integer, nullable=False)
     user = db.relationship("User",foreign_keys=[user_id], back_populates="friendships")
     friend = db.relationship("User", foreign_keys=[friend_id], passive_deletes=True)
+    __table_args__ = (
+        db.Index("ix_friends_user_friend_status", "user_id", "friend_id", "status"),
+        db.Index("ix_friends_friend_status", "friend_id", "status"),
+        db.Index("uq_friends_pair", "pair_low", "pair_high", unique=True),
+    )
+
+    @classmethod
+    def find_pair(cls, user_1, user_2):
+        """
+        Return the friendship between two users in either direction
+        """
+        return cls.query.filter_by(pair_low=min(user_1, user_2), pair_high=max(user_1, user_2)).first()
 
     def __init__(self, **kwargs):
         """
@@ -181,6 +201,8 @@ class Friend(db.Model):
         self.user_id = kwargs.get("user_id")
         self.friend_id = kwargs.get("friend_id")
         self.status = kwargs.get("status")
+        self.pair_low = min(self.user_id, self.friend_id)
+        self.pair_high = max(self.user_id, self.friend_id)
 
     def serialize(self):
         """
@@ -216,6 +238,10 @@ class Message(db.Model):
     sent_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     sender = db.relationship("User", foreign_keys=[sender_id], passive_deletes=True)
     receiver = db.relationship("User", foreign_keys=[receiver_id], passive_deletes=True)
+    __table_args__ = (
+        db.Index("ix_messages_sender_receiver_sent_at", "sender_id", "receiver_id", "sent_at"),
+        db.Index("ix_messages_sender_receiver_id", "sender_id", "receiver_id", "id"),
+    )
 
     def __init__(self, **kwargs):
         """
@@ -246,7 +272,51 @@ class Message(db.Model):
         """
         return{
             "content": self.content
-        }  
+        }
+
+class Conversation(db.Model):
+    """
+    Conversation model, a summary of the messages between two users kept up
+    to date as messages are sent and deleted. user_a_id is the smaller id
+    """
+    __tablename__="conversations"
+    id=db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_a_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    user_b_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    last_preview = db.Column(db.String, nullable=False)
+    last_sent_at = db.Column(db.DateTime, nullable=False)
+    unread_a = db.Column(db.Integer, default=0, nullable=False)
+    unread_b = db.Column(db.Integer, default=0, nullable=False)
+    read_a_id = db.Column(db.Integer)
+    read_b_id = db.Column(db.Integer)
+    __table_args__ = (
+        db.UniqueConstraint("user_a_id", "user_b_id", name="uq_conversations_users"),
+        db.Index("ix_conversations_user_a_sent_at", "user_a_id", "last_sent_at"),
+        db.Index("ix_conversations_user_b_sent_at", "user_b_id", "last_sent_at"),
+    )
+
+    def serialize_for(self, user_id):
+        """
+        Serializes the conversation as seen by user_id
+        """
+        side = "a" if user_id == self.user_a_id else "b"
+        return {
+            "message_id": self.last_message_id,
+            "content": self.last_preview,
+            "sent_at": self.last_sent_at.isoformat(),
+            "unread": getattr(self, "unread_" + side)
+        }
+
+class RosterSubject(db.Model):
+    """
+    RosterSubject model, the content hash of the roster response of a
+    subject whose classes are in the courses and sessions tables
+    """
+    __tablename__="roster_subjects"
+    roster = db.Column(db.String, primary_key=True)
+    subject = db.Column(db.String, primary_key=True)
+    digest = db.Column(db.String, nullable=False)
 
 class Major(db.Model):
     """
@@ -313,6 +383,9 @@ class Interest(db.Model):
     category_id=db.Column(db.Integer, db.ForeignKey("interest_categories.id"), nullable=False)
     category = db.relationship("InterestCategory", back_populates="interests")
     users = db.relationship("User", secondary=user_interest_table, back_populates="interests", passive_deletes=True)
+    __table_args__ = (
+        db.Index("ix_interests_name_category", "name", "category_id"),
+    )
 
     def __init__(self, **kwargs):
         self.name = kwargs.get("name", "")
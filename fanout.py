@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import socketserver
+
+FANOUT_SOCKET = os.environ.get("FANOUT_SOCKET", "/tmp/studdybuddy-fanout.sock")
+RECONNECT_DELAY = 1
+
+class InProcessHub:
+    """
+    Delivers events to the WebSocket connections held by this process only
+    """
+    def __init__(self):
+        """
+        Initializes a hub without connections
+        """
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def register(self, user_id, ws):
+        """
+        Routes events for user_id to ws, replacing an older connection of the same user
+        """
+        with self.lock:
+            self.connections[user_id] = ws
+
+    def unregister(self, user_id, ws):
+        """
+        Stops routing events for user_id if ws is still its connection
+        """
+        with self.lock:
+            if self.connections.get(user_id) is ws:
+                del self.connections[user_id]
+
+    def deliver(self, user_ids, payload):
+        """
+        Sends payload to the local connections of user_ids, returns the ids that were not local
+        """
+        missing = []
+        for user_id in user_ids:
+            with self.lock:
+                ws = self.connections.get(user_id)
+            if ws is None:
+                missing.append(user_id)
+                continue
+            try:
+                ws.send(payload)
+            except Exception as e:
+                print("Failed to deliver to", user_id, str(e))
+        return missing
+
+    def publish(self, user_ids, payload):
+        """
+        Sends a JSON string payload to every connected user in user_ids
+        """
+        self.deliver(user_ids, payload)
+
+
+class BrokerHub(InProcessHub):
+    """
+    Delivers events locally and forwards the rest to a broker over a Unix
+    socket, which relays them to whichever worker holds the recipient
+    """
+    def __init__(self, path=FANOUT_SOCKET):
+        """
+        Initializes the hub and starts the thread connected to the broker at path
+        """
+        super().__init__()
+        self.path = path
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.connected = threading.Event()
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def send_frame(self, frame):
+        """
+        Writes one newline terminated JSON frame to the broker, dropping it while disconnected
+        """
+        data = (json.dumps(frame) + "\n").encode()
+        with self.send_lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.sock = None
+
+    def register(self, user_id, ws):
+        """
+        Routes events for user_id to ws and subscribes this worker to them at the broker
+        """
+        super().register(user_id, ws)
+        self.send_frame({"op": "sub", "users": [user_id]})
+
+    def unregister(self, user_id, ws):
+        """
+        Stops routing events for user_id and unsubscribes when no local connection remains
+        """
+        super().unregister(user_id, ws)
+        with self.lock:
+            gone = user_id not in self.connections
+        if gone:
+            self.send_frame({"op": "unsub", "users": [user_id]})
+
+    def publish(self, user_ids, payload):
+        """
+        Sends payload to local recipients directly and to the others through the broker
+        """
+        missing = self.deliver(user_ids, payload)
+        if missing:
+            self.send_frame({"op": "pub", "users": missing, "payload": payload})
+
+    def listen(self):
+        """
+        Keeps a connection to the broker open and delivers the events it relays
+        """
+        while True:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+            except OSError:
+                time.sleep(RECONNECT_DELAY)
+                continue
+            with self.lock:
+                users = list(self.connections)
+            with self.send_lock:
+                self.sock = sock
+            self.send_frame({"op": "sub", "users": users})
+            self.connected.set()
+            try:
+                for line in sock.makefile("rb"):
+                    frame = json.loads(line)
+                    self.deliver(frame["users"], frame["payload"])
+            except (OSError, ValueError):
+                pass
+            self.connected.clear()
+            with self.send_lock:
+                self.sock = None
+            sock.close()
+            time.sleep(RECONNECT_DELAY)
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one worker connected to the broker
+    """
+    def handle(self):
+        """
+        Applies the worker's sub/unsub frames and relays its pub frames to subscribed workers
+        """
+        server = self.server
+        subscribed = set()
+        try:
+            for line in self.rfile:
+                frame = json.loads(line)
+                op = frame.get("op")
+                if op == "sub":
+                    with server.lock:
+                        for user_id in frame["users"]:
+                            server.subscriptions.setdefault(user_id, set()).add(self)
+                    subscribed.update(frame["users"])
+                elif op == "unsub":
+                    with server.lock:
+                        for user_id in frame["users"]:
+                            server.subscriptions.get(user_id, set()).discard(self)
+                    subscribed.difference_update(frame["users"])
+                elif op == "pub":
+                    targets = {}
+                    with server.lock:
+                        for user_id in frame["users"]:
+                            for handler in server.subscriptions.get(user_id, ()):
+                                if handler is not self:
+                                    targets.setdefault(handler, []).append(user_id)
+                    for handler, users in targets.items():
+                        handler.relay(users, frame["payload"])
+        finally:
+            with server.lock:
+                for user_id in subscribed:
+                    handlers = server.subscriptions.get(user_id)
+                    if handlers is not None:
+                        handlers.discard(self)
+                        if not handlers:
+                            del server.subscriptions[user_id]
+
+    def setup(self):
+        """
+        Adds the lock serializing writes to this worker
+        """
+        super().setup()
+        self.write_lock = threading.Lock()
+
+    def relay(self, users, payload):
+        """
+        Forwards a payload for users to this worker
+        """
+        data = (json.dumps({"users": users, "payload": payload}) + "\n").encode()
+        try:
+            with self.write_lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+        except OSError:
+            pass
+
+
+class Broker(socketserver.ThreadingUnixStreamServer):
+    """
+    Unix socket broker routing events between server.py workers
+    """
+    daemon_threads = True
+
+    def __init__(self, path=FANOUT_SOCKET):
+        """
+        Binds the broker to path, replacing a stale socket file
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, BrokerHandler)
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+
+def make_hub():
+    """
+    Returns a BrokerHub when FANOUT_BROKER is set, otherwise an InProcessHub
+    """
+    if os.environ.get("FANOUT_BROKER"):
+        return BrokerHub(FANOUT_SOCKET)
+    return InProcessHub()
+
+
+class BenchSocket:
+    """
+    Stand-in WebSocket recording the payloads delivered to it
+    """
+    def __init__(self, received):
+        """
+        Initializes a socket appending every payload to the received queue
+        """
+        self.received = received
+
+    def send(self, payload):
+        """
+        Records a delivered payload
+        """
+        self.received.put(payload)
+
+
+def bench_worker(index, workers, messages, path, results):
+    """
+    Pings the next worker's user through the broker and measures the round trip of each reply
+    """
+    import queue
+    received = queue.Queue()
+    hub = BrokerHub(path)
+    hub.register("user%d" % index, BenchSocket(received))
+    hub.connected.wait()
+    time.sleep(0.5)
+    target = "user%d" % ((index + 1) % workers)
+    me = "user%d" % index
+    latencies = []
+    sent = 0
+    pending = {}
+    while len(latencies) < messages:
+        if sent < messages and not pending:
+            pending[sent] = time.perf_counter()
+            hub.publish([target], json.dumps({"type": "ping", "from": me, "seq": sent}))
+            sent += 1
+        event = json.loads(received.get())
+        if event["type"] == "ping":
+            hub.publish([event["from"]], json.dumps({"type": "pong", "seq": event["seq"]}))
+        else:
+            latencies.append(time.perf_counter() - pending.pop(event["seq"]))
+    # Keep answering pings until every worker is done
+    deadline = time.time() + 2
+    while time.time() < deadline:
+        try:
+            event = json.loads(received.get(timeout=0.1))
+        except queue.Empty:
+            continue
+        if event["type"] == "ping":
+            hub.publish([event["from"]], json.dumps({"type": "pong", "seq": event["seq"]}))
+    results.put(latencies)
+
+
+def benchmark(workers=4, messages=2000, path=FANOUT_SOCKET + ".bench"):
+    """
+    Runs a broker and `workers` processes pinging each other, prints one-way delivery latency
+    """
+    import multiprocessing
+    broker = Broker(path)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=bench_worker, args=(i, workers, messages, path, results))
+        for i in range(workers)
+    ]
+    for p in processes:
+        p.start()
+    latencies = []
+    for _ in processes:
+        latencies.extend(results.get())
+    for p in processes:
+        p.join()
+    broker.shutdown()
+    # A round trip is two deliveries through the broker
+    latencies = sorted(l / 2 for l in latencies)
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e6
+    print("workers=%d deliveries=%d p50=%.0fus p95=%.0fus p99=%.0fus" % (
+        workers, 2 * len(latencies), percentile(0.5), percentile(0.95), percentile(0.99)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(workers=int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    else:
+        broker = Broker(FANOUT_SOCKET)
+        print("Fan-out broker listening on", FANOUT_SOCKET)
+        broker.serve_forever()
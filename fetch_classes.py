@@ -1,81 +1,453 @@
-import time 
-import requests 
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import requests
 import json
-from db import db, Course, Session
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from sqlalchemy.dialects.sqlite import insert
+from db import db, Course, Session, RosterSubject
 
 BASE_URL = "https://classes.cornell.edu/api/2.0"
 ROSTER = "SP26"
 API_TIMEOUT = 10
 API_RATE_LIMIT = 1
+API_BURST = 1
+API_RETRIES = 3
+API_BACKOFF = 1
+FETCH_WORKERS = 8
+SYNC_BATCH = 5000
+SHADOW_DB = "roster_shadow.db"
+ROSTER_CACHE_DIR = os.environ.get("ROSTER_CACHE_DIR", "roster_cache")
 
-def fetch_subjects():
+class TokenBucket:
+    """
+    Thread safe token bucket allowing one request every `interval` seconds on
+    average across all threads, with bursts of up to `capacity` requests
+    """
+    def __init__(self, interval=API_RATE_LIMIT, capacity=API_BURST):
+        """
+        Initializes a full bucket
+        """
+        self.interval = interval
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.interval > 0:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) / self.interval)
+                else:
+                    self.tokens = self.capacity
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * self.interval
+            time.sleep(wait)
+
+def make_session(workers=FETCH_WORKERS):
+    """
+    Returns a requests session whose keep-alive connection pool fits every worker
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_content(url, params, session=None, bucket=None):
+    """
+    GETs url once a rate limit token is available, retrying with exponential
+    backoff on errors and non-200 responses. Returns the response body, or
+    None if every attempt fails
+    """
+    session = session or requests
+    for attempt in range(API_RETRIES + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            result = session.get(url, params=params, timeout=API_TIMEOUT)
+            if result.status_code==200:
+                return result.content
+        except requests.RequestException as e:
+            print("Request error for "+url+": "+str(e))
+        if attempt < API_RETRIES:
+            time.sleep(API_BACKOFF * 2 ** attempt)
+    return None
+
+def get_json(url, params, session=None, bucket=None):
+    """
+    Same as get_content but decodes the JSON body
+    """
+    content = get_content(url, params, session, bucket)
+    if content is None:
+        return None
+    return json.loads(content)
+
+def fetch_subjects(base_url=BASE_URL, roster=ROSTER, session=None, bucket=None):
     """
     Fetches the list of subjects for the configured roster from the Cornell classes API.
     """
-    url = BASE_URL + "/config/subjects.json"
-    result = requests.get(url, params={"roster":ROSTER}, timeout=API_TIMEOUT)
-    if result.status_code!=200:
+    url = base_url + "/config/subjects.json"
+    result = get_json(url, {"roster": roster}, session, bucket)
+    if result is None:
         raise Exception("Failed to get subjects")
-    return result.json()["data"]["subjects"]
+    return result["data"]["subjects"]
 
-def fetch_classes_for_subject(subject):
+def fetch_classes_for_subject(subject, base_url=BASE_URL, roster=ROSTER, session=None, bucket=None):
     """
     Fetches all classes for a given subject from the Cornell classes API.
     """
-    url = BASE_URL + "/search/classes.json"
-    result = requests.get(url, params={"roster": ROSTER, "subject": subject}, timeout=API_TIMEOUT)
-    if result.status_code!=200:
+    url = base_url + "/search/classes.json"
+    result = get_json(url, {"roster": roster, "subject": subject}, session, bucket)
+    if result is None:
         print("Failed to get classes for"+subject)
         return []
-    time.sleep(API_RATE_LIMIT)
-    return result.json()["data"]["classes"]
+    return result["data"]["classes"]
+
+def fetch_subject_payload(subject, base_url=BASE_URL, roster=ROSTER, session=None, bucket=None):
+    """
+    Fetches the raw /search/classes.json response of a subject.
+    Returns (subject, payload, content hash), payload is None if the request failed
+    """
+    url = base_url + "/search/classes.json"
+    payload = get_content(url, {"roster": roster, "subject": subject}, session, bucket)
+    if payload is None:
+        print("Failed to get classes for"+subject)
+        return subject, None, None
+    return subject, payload, hashlib.sha256(payload).hexdigest()
+
+class RosterCache:
+    """
+    On-disk cache of /search/classes.json responses, one file per roster and
+    subject, plus an index of the content hash of each file
+    """
+    def __init__(self, directory=ROSTER_CACHE_DIR, roster=ROSTER):
+        """
+        Opens the cache directory of a roster, creating it if needed
+        """
+        self.directory = os.path.join(directory, roster)
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def path(self, subject):
+        """
+        Returns the file holding the cached response of a subject
+        """
+        return os.path.join(self.directory, subject + ".json")
+
+    def digest(self, subject):
+        """
+        Returns the content hash of the cached response of a subject, or None
+        """
+        return self.index.get(subject)
+
+    def subjects(self):
+        """
+        Returns every cached subject
+        """
+        return sorted(self.index)
+
+    def load(self, subject):
+        """
+        Returns the cached response of a subject, or None if it is missing or corrupt
+        """
+        try:
+            with open(self.path(subject), "rb") as f:
+                payload = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(payload).hexdigest() != self.index.get(subject):
+            print("Corrupt cache entry for "+subject)
+            return None
+        return payload
 
-def fetch_all(app):
+    def store(self, entries):
+        """
+        Writes (subject, payload, hash) entries and then the index, each file replaced atomically
+        """
+        if not entries:
+            return
+        for subject, payload, digest in entries:
+            self.write(self.path(subject), payload)
+            self.index[subject] = digest
+        self.write(self.index_path, json.dumps(self.index, sort_keys=True).encode())
+
+    @staticmethod
+    def write(path, data):
+        """
+        Replaces the file at path with data so readers never see a partial file
+        """
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+SHADOW_SCHEMA = """
+CREATE TABLE courses (code TEXT PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE sessions (
+    class_number TEXT PRIMARY KEY,
+    course_id INTEGER,
+    course_code TEXT,
+    name TEXT NOT NULL,
+    time TEXT
+);
+"""
+
+# Course ids and session ids of existing rows are kept, because the upserts
+# only update names and times, so user_session_association stays valid
+SWAP_COURSES = """
+INSERT INTO main.courses (code, name)
+SELECT code, name FROM shadow.courses WHERE true
+ON CONFLICT (code) DO UPDATE SET name = excluded.name
+"""
+SWAP_SESSIONS = """
+INSERT INTO main.sessions (course_id, class_number, name, time)
+SELECT COALESCE(s.course_id, c.id), s.class_number, s.name, s.time
+FROM shadow.sessions s LEFT JOIN main.courses c ON c.code = s.course_code WHERE true
+ON CONFLICT (class_number) DO UPDATE SET name = excluded.name, time = excluded.time
+"""
+
+class RosterSync:
+    """
+    Diffs fetched classes against the courses and sessions already stored,
+    stages the changes in a shadow database file and merges them into the
+    live tables in one short transaction, so the sync never holds the live
+    database's write lock while downloading or parsing
+    """
+    def __init__(self, shadow_path=None):
+        """
+        Preloads every existing course code and session class number and
+        creates empty shadow tables, must run inside an app context
+        """
+        self.courses = {
+            code: [course_id, name]
+            for course_id, code, name in db.session.query(Course.id, Course.code, Course.name)
+        }
+        self.sessions = {
+            class_number: [course_id, name, time]
+            for class_number, course_id, name, time in db.session.query(
+                Session.class_number, Session.course_id, Session.name, Session.time
+            )
+        }
+        db.session.rollback()
+        if shadow_path is None:
+            shadow_path = os.path.join(os.path.dirname(db.engine.url.database), SHADOW_DB)
+        self.shadow_path = shadow_path
+        if os.path.exists(shadow_path):
+            os.remove(shadow_path)
+        self.shadow = sqlite3.connect(shadow_path)
+        self.shadow.executescript(SHADOW_SCHEMA)
+        self.pending_courses = {}
+        self.pending_sessions = {}
+        self.counts = {
+            "courses": {"inserted": 0, "updated": 0, "unchanged": 0},
+            "sessions": {"inserted": 0, "updated": 0, "unchanged": 0}
+        }
+
+    def pending(self):
+        """
+        Returns the number of rows waiting to be written
+        """
+        return len(self.pending_courses) + len(self.pending_sessions)
+
+    def add_classes(self, classes):
+        """
+        Diffs one subject's classes against the known rows and queues the changes
+        """
+        for item in classes:
+            course_code = item["subject"]+item["catalogNbr"]
+            course_name = item["titleShort"]
+            course = self.courses.get(course_code)
+            if course is None:
+                self.courses[course_code] = [None, course_name]
+                self.pending_courses[course_code] = course_name
+                self.counts["courses"]["inserted"] += 1
+            elif course[1]!=course_name:
+                course[1] = course_name
+                self.pending_courses[course_code] = course_name
+                self.counts["courses"]["updated"] += 1
+            else:
+                self.counts["courses"]["unchanged"] += 1
+            groups = item.get("enrollGroups",[])
+            for group in groups:
+                sections = group.get("classSections",[])
+                for session in sections:
+                    session_name = session["ssrComponent"]+session["section"]
+                    class_number = str(session["classNbr"])
+                    meeting = session.get("meetings",[])
+                    if meeting!=[]:
+                        time = meeting[0]["pattern"]+" "+meeting[0]["timeStart"]
+                    else:
+                        time = ""
+                    existing = self.sessions.get(class_number)
+                    if existing is None:
+                        self.sessions[class_number] = [None, session_name, time]
+                        self.pending_sessions[class_number] = course_code
+                        self.counts["sessions"]["inserted"] += 1
+                    elif existing[1]!=session_name or existing[2]!=time:
+                        existing[1] = session_name
+                        existing[2] = time
+                        self.pending_sessions.setdefault(class_number, None)
+                        self.counts["sessions"]["updated"] += 1
+                    else:
+                        self.counts["sessions"]["unchanged"] += 1
+
+    def flush(self):
+        """
+        Writes every queued course and session change into the shadow tables
+        """
+        self.shadow.executemany(
+            "INSERT OR REPLACE INTO courses (code, name) VALUES (?, ?)",
+            self.pending_courses.items()
+        )
+        rows = []
+        for class_number, course_code in self.pending_sessions.items():
+            course_id, name, time = self.sessions[class_number]
+            rows.append((class_number, course_id, course_code, name, time))
+        self.shadow.executemany(
+            "INSERT OR REPLACE INTO sessions (class_number, course_id, course_code, name, time) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        self.shadow.commit()
+        self.pending_courses = {}
+        self.pending_sessions = {}
+
+    def swap(self):
+        """
+        Merges the shadow tables into the live courses and sessions tables in one transaction
+        """
+        self.flush()
+        self.shadow.close()
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql("ATTACH DATABASE ? AS shadow", (self.shadow_path,))
+            try:
+                conn.exec_driver_sql(SWAP_COURSES)
+                conn.exec_driver_sql(SWAP_SESSIONS)
+                conn.commit()
+            finally:
+                conn.rollback()
+                conn.exec_driver_sql("DETACH DATABASE shadow")
+        os.remove(self.shadow_path)
+
+def synced_digests(roster=ROSTER):
+    """
+    Returns the hash of the response last synced into the database for each
+    subject of a roster, none when the courses table was emptied behind its back
+    """
+    digests = {}
+    if db.session.query(Course.id).first() is not None:
+        digests = dict(db.session.query(RosterSubject.subject, RosterSubject.digest).filter_by(roster=roster))
+    db.session.rollback()
+    return digests
+
+def record_synced(roster, entries):
+    """
+    Stores (subject, hash) entries of responses now synced into the database
+    """
+    if not entries:
+        return
+    stmt = insert(RosterSubject).values([
+        {"roster": roster, "subject": subject, "digest": digest} for subject, digest in entries
+    ])
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=["roster", "subject"], set_={"digest": stmt.excluded.digest}
+    ))
+    db.session.commit()
+
+def forget_synced():
+    """
+    Makes the next sync parse every subject again, for changes to courses or
+    sessions made outside a sync. Runs in the caller's transaction
+    """
+    db.session.query(RosterSubject).delete()
+
+def fetch_all(app, base_url=BASE_URL, roster=ROSTER, workers=FETCH_WORKERS, cache_dir=ROSTER_CACHE_DIR, force=False):
     """
     Fetches all subjects and classes and syncs them into the local database.
+
+    Subjects are downloaded concurrently by a pool of workers sharing one
+    keep-alive session and one rate limit, while the calling thread diffs
+    each subject as soon as its download completes and writes the changes
+    into shadow tables in batches of SYNC_BATCH rows, which are swapped
+    into the live tables at the end. Subjects whose response hash matches the
+    one last synced into the database are skipped without parsing unless
+    force is set. Returns the inserted, updated and unchanged counts of
+    courses and sessions.
     """
-    subjects=fetch_subjects()
+    session = make_session(workers)
+    bucket = TokenBucket(API_RATE_LIMIT, API_BURST)
+    cache = RosterCache(cache_dir, roster)
+    subjects=fetch_subjects(base_url, roster, session, bucket)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(fetch_subject_payload, subject["value"], base_url, roster, session, bucket)
+            for subject in subjects
+        ]
+        with app.app_context():
+            synced = synced_digests(roster)
+            sync = RosterSync()
+            sync.counts["subjects"] = {"synced": 0, "skipped": 0, "failed": 0}
+            written = []
+            applied = []
+            for future in as_completed(futures):
+                subject, payload, digest = future.result()
+                if payload is None:
+                    sync.counts["subjects"]["failed"] += 1
+                    continue
+                if cache.digest(subject) != digest:
+                    written.append((subject, payload, digest))
+                if not force and synced.get(subject) == digest:
+                    sync.counts["subjects"]["skipped"] += 1
+                    continue
+                sync.add_classes(json.loads(payload)["data"]["classes"])
+                sync.counts["subjects"]["synced"] += 1
+                applied.append((subject, digest))
+                if sync.pending() >= SYNC_BATCH:
+                    sync.flush()
+            sync.swap()
+            cache.store(written)
+            record_synced(roster, applied)
+    session.close()
+    print("Sync done:", sync.counts)
+    return sync.counts
 
+def replay_snapshot(app, cache_dir=ROSTER_CACHE_DIR, roster=ROSTER):
+    """
+    Syncs every cached subject response of a roster into the database
+    without any network access, e.g. to fill an empty database
+    """
+    cache = RosterCache(cache_dir, roster)
     with app.app_context():
-        for subject in subjects:
-            subject = subject["value"]
-            classes = fetch_classes_for_subject(subject)
-            for item in classes:
-                course_code = item["subject"]+item["catalogNbr"]
-                course_name = item["titleShort"]
-                course = Course.query.filter_by(code=course_code).first()
-                if course is None:
-                    course = Course(code=course_code, name=course_name)
-                    db.session.add(course)
-                    db.session.commit()
-                else:
-                    if course.name!=course_name:
-                        course.name=course_name 
-                    if course.code!=course_code:
-                        course.code=course_code 
-                groups = item.get("enrollGroups",[])
-                for group in groups:
-                    sections = group.get("classSections",[])
-                    for session in sections:
-                        session_name = session["ssrComponent"]+session["section"]
-                        class_number = str(session["classNbr"])
-                        meeting = session.get("meetings",[])
-                        if meeting!=[]:
-                            time = meeting[0]["pattern"]+" "+meeting[0]["timeStart"]
-                        else:
-                            time = ""
-                        existing = Session.query.filter_by(class_number=class_number).first()
-                        if existing is None:
-                            new_session = Session(course_id=course.id, class_number=class_number, name=session_name, time=time)
-                            db.session.add(new_session)
-                        else:
-                            if existing.name!=session_name:
-                                existing.name=session_name 
-                            if existing.time!=time:
-                                existing.time=time
-                db.session.commit()
-
-            
-            
-
-    
\ No newline at end of file
+        sync = RosterSync()
+        sync.counts["subjects"] = {"synced": 0, "skipped": 0, "failed": 0}
+        applied = []
+        for subject in cache.subjects():
+            payload = cache.load(subject)
+            if payload is None:
+                sync.counts["subjects"]["failed"] += 1
+                continue
+            sync.add_classes(json.loads(payload)["data"]["classes"])
+            sync.counts["subjects"]["synced"] += 1
+            applied.append((subject, cache.digest(subject)))
+            if sync.pending() >= SYNC_BATCH:
+                sync.flush()
+        sync.swap()
+        record_synced(roster, applied)
+    print("Replay done:", sync.counts)
+    return sync.counts
@@ -0,0 +1,126 @@
+import threading
+from db import db, Friend
+
+ACCEPTED = "Accepted"
+
+class FriendGraph:
+    """
+    Adjacency sets of the friendship graph: accepted friends, and pending
+    requests by receiver and by sender, so friend lists and friendship checks
+    need no query of the friends table
+    """
+    def __init__(self):
+        """
+        Initializes an empty graph, call build() to load it from the database
+        """
+        self.lock = threading.Lock()
+        self.accepted = {}
+        self.pending_in = {}
+        self.pending_out = {}
+
+    def build(self):
+        """
+        Loads every friendship from the friends table, must run inside an app context
+        """
+        rows = db.session.query(Friend.user_id, Friend.friend_id, Friend.status).all()
+        accepted = {}
+        pending_in = {}
+        pending_out = {}
+        for user_id, friend_id, status in rows:
+            if status == ACCEPTED:
+                accepted.setdefault(user_id, set()).add(friend_id)
+                accepted.setdefault(friend_id, set()).add(user_id)
+            else:
+                pending_out.setdefault(user_id, set()).add(friend_id)
+                pending_in.setdefault(friend_id, set()).add(user_id)
+        with self.lock:
+            self.accepted = accepted
+            self.pending_in = pending_in
+            self.pending_out = pending_out
+
+    @staticmethod
+    def unlink(edges, user_id, other_id):
+        """
+        Removes other_id from the set of user_id, caller holds the lock
+        """
+        ids = edges.get(user_id)
+        if ids is not None:
+            ids.discard(other_id)
+            if not ids:
+                del edges[user_id]
+
+    def add_request(self, user_id, friend_id):
+        """
+        Records a pending request sent by user_id to friend_id
+        """
+        with self.lock:
+            self.pending_out.setdefault(user_id, set()).add(friend_id)
+            self.pending_in.setdefault(friend_id, set()).add(user_id)
+
+    def accept(self, user_id, friend_id):
+        """
+        Turns the request sent by user_id to friend_id into a friendship
+        """
+        with self.lock:
+            self.unlink(self.pending_out, user_id, friend_id)
+            self.unlink(self.pending_in, friend_id, user_id)
+            self.accepted.setdefault(user_id, set()).add(friend_id)
+            self.accepted.setdefault(friend_id, set()).add(user_id)
+
+    def remove(self, user_id, friend_id):
+        """
+        Forgets any friendship or request between two users
+        """
+        with self.lock:
+            for a, b in [(user_id, friend_id), (friend_id, user_id)]:
+                self.unlink(self.accepted, a, b)
+                self.unlink(self.pending_out, a, b)
+                self.unlink(self.pending_in, a, b)
+
+    def remove_user(self, user_id):
+        """
+        Forgets every friendship and request of a deleted user
+        """
+        with self.lock:
+            for edges in [self.accepted, self.pending_in, self.pending_out]:
+                for other_id in edges.pop(user_id, ()):
+                    self.unlink(self.accepted, other_id, user_id)
+                    self.unlink(self.pending_in, other_id, user_id)
+                    self.unlink(self.pending_out, other_id, user_id)
+
+    def friends(self, user_id):
+        """
+        Returns the sorted ids of a user's accepted friends
+        """
+        with self.lock:
+            return sorted(self.accepted.get(user_id, ()))
+
+    def friends_of(self, user_ids):
+        """
+        Returns the sorted friend ids of each user in user_ids
+        """
+        with self.lock:
+            return {user_id: sorted(self.accepted.get(user_id, ())) for user_id in user_ids}
+
+    def requests(self, user_id):
+        """
+        Returns the sorted ids of users with a pending request to and from user_id
+        """
+        with self.lock:
+            return {
+                "incoming": sorted(self.pending_in.get(user_id, ())),
+                "outgoing": sorted(self.pending_out.get(user_id, ()))
+            }
+
+    def status(self, user_id, friend_id):
+        """
+        Returns "Accepted", "Incoming", "Outgoing" or None for the relation of user_id to friend_id
+        """
+        with self.lock:
+            if friend_id in self.accepted.get(user_id, ()):
+                return ACCEPTED
+            if friend_id in self.pending_in.get(user_id, ()):
+                return "Incoming"
+            if friend_id in self.pending_out.get(user_id, ()):
+                return "Outgoing"
+            return None
@@ -0,0 +1,123 @@
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import requests
+from google.auth import jwt
+from requests.adapters import HTTPAdapter
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+CERTS_TIMEOUT = 10
+# Used when the certs response carries no usable cache headers
+DEFAULT_CERTS_MAX_AGE = 300
+# Minimum seconds between forced refetches for tokens with an unknown key id
+CERTS_MIN_REFRESH = 60
+TOKEN_CACHE_SIZE = 1024
+CLOCK_SKEW = 10
+
+class GoogleTokenVerifier:
+    """
+    Verifies Google ID tokens against Google's signing certs, keeping the
+    certs for as long as their cache headers allow and remembering tokens
+    that were already verified until they expire
+    """
+    def __init__(self, certs_url=GOOGLE_CERTS_URL, session=None, cache_size=TOKEN_CACHE_SIZE):
+        """
+        Initializes a verifier fetching certs from certs_url over a pooled keep-alive session
+        """
+        self.certs_url = certs_url
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self.lock = threading.Lock()
+        self.certs = None
+        self.certs_expiry = 0
+        self.certs_fetched = 0
+        self.certs_refreshed = 0
+        self.tokens = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.cert_fetches = 0
+
+    @staticmethod
+    def max_age(headers):
+        """
+        Returns how many seconds a response may be cached according to its headers
+        """
+        cache_control = headers.get("Cache-Control", "").lower()
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            return 0
+        match = re.search(r"max-age=(\d+)", cache_control)
+        if not match:
+            return DEFAULT_CERTS_MAX_AGE
+        age = headers.get("Age", "0")
+        return max(0, int(match.group(1)) - (int(age) if age.isdigit() else 0))
+
+    def get_certs(self, refresh=False):
+        """
+        Returns Google's signing certs by key id, fetching them when the cached copy is stale
+        """
+        with self.lock:
+            if self.certs is not None:
+                if not refresh and time.time() < self.certs_expiry:
+                    return self.certs
+                if refresh and time.time() < self.certs_refreshed + CERTS_MIN_REFRESH:
+                    return self.certs
+        result = self.session.get(self.certs_url, timeout=CERTS_TIMEOUT)
+        if result.status_code!=200:
+            raise ValueError("Failed to fetch Google certs")
+        certs = result.json()
+        with self.lock:
+            self.certs = certs
+            self.certs_fetched = time.time()
+            self.certs_expiry = self.certs_fetched + self.max_age(result.headers)
+            if refresh:
+                self.certs_refreshed = self.certs_fetched
+            self.cert_fetches += 1
+        return certs
+
+    def verify(self, token):
+        """
+        Returns the claims of a valid Google ID token, raises ValueError otherwise.
+        The audience is not checked here, callers compare idinfo["aud"] themselves
+        """
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        now = time.time()
+        with self.lock:
+            cached = self.tokens.get(digest)
+            if cached is not None and now < cached["exp"]:
+                self.tokens.move_to_end(digest)
+                self.hits += 1
+                return dict(cached)
+            self.misses += 1
+        certs = self.get_certs()
+        if jwt.decode_header(token).get("kid") not in certs:
+            # The token may be signed with a key published after our certs were cached
+            certs = self.get_certs(refresh=True)
+        idinfo = jwt.decode(token, certs=certs, clock_skew_in_seconds=CLOCK_SKEW)
+        if idinfo.get("iss") not in GOOGLE_ISSUERS:
+            raise ValueError("Wrong issuer")
+        with self.lock:
+            self.tokens[digest] = idinfo
+            self.tokens.move_to_end(digest)
+            while len(self.tokens) > self.cache_size:
+                self.tokens.popitem(last=False)
+        return dict(idinfo)
+
+    def stats(self):
+        """
+        Returns the token cache counters and the number of cert fetches
+        """
+        with self.lock:
+            return {
+                "size": len(self.tokens),
+                "hits": self.hits,
+                "misses": self.misses,
+                "cert_fetches": self.cert_fetches
+            }
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import queue
+import tempfile
+import threading
+from concurrent.futures import Future
+
+GROUP_COMMIT_SIZE = 64
+GROUP_COMMIT_WAIT = 0.005
+
+class GroupCommitWriter:
+    """
+    Write-behind queue inserting rows from many threads with one commit per
+    batch of up to `max_batch` rows or `max_wait` seconds
+    """
+    def __init__(self, app, db, max_batch=GROUP_COMMIT_SIZE, max_wait=GROUP_COMMIT_WAIT):
+        """
+        Starts the writer thread, which uses its own app context and session
+        """
+        self.app = app
+        self.db = db
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.rows = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, row):
+        """
+        Queues a model instance for insertion. The returned future resolves to
+        row.serialize() once the row is durably committed
+        """
+        future = Future()
+        self.queue.put((row, future))
+        return future
+
+    def next_batch(self):
+        """
+        Blocks for the first queued row, then collects more until the batch is full or max_wait passes
+        """
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        """
+        Commits batches forever
+        """
+        with self.app.app_context():
+            while True:
+                batch = self.next_batch()
+                try:
+                    results = self.commit([row for row, _ in batch])
+                except Exception:
+                    self.db.session.rollback()
+                    # Commit the rows one by one, so only the bad row's sender gets the error
+                    for row, future in batch:
+                        try:
+                            result = self.commit([row])[0]
+                        except Exception as e:
+                            self.db.session.rollback()
+                            future.set_exception(e)
+                        else:
+                            self.batches += 1
+                            self.rows += 1
+                            future.set_result(result)
+                    continue
+                self.batches += 1
+                self.rows += len(batch)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+    def commit(self, rows):
+        """
+        Inserts rows in one transaction and returns their serializations
+        """
+        self.db.session.add_all(rows)
+        # Flushing fills in generated ids and defaults, so the rows can be
+        # serialized before commit expires them
+        self.db.session.flush()
+        results = [row.serialize() for row in rows]
+        self.db.session.commit()
+        return results
+
+
+def benchmark(threads=8, messages=250):
+    """
+    Compares messages/sec of one commit per message against group commits
+    with `threads` senders inserting `messages` rows each into a scratch database
+    """
+    from flask import Flask
+    from flask_sqlalchemy import SQLAlchemy
+
+    directory = tempfile.mkdtemp()
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(directory, "bench.db")
+    db = SQLAlchemy(app)
+
+    class BenchMessage(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        sent_by = db.Column(db.String, nullable=False)
+        message = db.Column(db.String, nullable=False)
+
+        def serialize(self):
+            return {"id": self.id, "sent_by": self.sent_by, "message": self.message}
+
+    with app.app_context():
+        db.create_all()
+        # The default busy handler makes concurrent single commits fail
+        # instead of queueing, give them the same chance as the writer
+        db.session.execute(db.text("PRAGMA busy_timeout=30000"))
+
+    def direct(sender):
+        with app.app_context():
+            db.session.execute(db.text("PRAGMA busy_timeout=30000"))
+            for i in range(messages):
+                row = BenchMessage(sent_by=sender, message="m%d" % i)
+                db.session.add(row)
+                db.session.commit()
+                row.serialize()
+
+    writer = GroupCommitWriter(app, db)
+
+    def grouped(sender):
+        for i in range(messages):
+            writer.submit(BenchMessage(sent_by=sender, message="m%d" % i)).result()
+
+    for name, target in [("commit per message", direct), ("group commit", grouped)]:
+        workers = [threading.Thread(target=target, args=("u%d" % t,)) for t in range(threads)]
+        start = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+        print("%-20s %6d messages in %.2fs, %.0f messages/sec" % (
+            name, threads * messages, elapsed, threads * messages / elapsed))
+    print("group commit batches: %d, average %.1f messages per commit" % (
+        writer.batches, writer.rows / max(writer.batches, 1)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
@@ -0,0 +1,178 @@
+import gzip
+import uuid
+import hashlib
+import threading
+from functools import wraps
+from collections import OrderedDict
+from flask import request, Response, g
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESPONSE_CACHE_SIZE = 256
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+class VersionedResponseCache:
+    """
+    Encoded JSON responses of read routes whose data only changes when a
+    version is bumped. Responses carry an ETag of the version and the request
+    path, so If-None-Match is answered with 304 without running the route,
+    and each body is compressed once per encoding
+    """
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, source=None):
+        """
+        Initializes an empty cache at version 0. source, if given, returns a
+        token of the data that other processes may change, such as a file's
+        identity, and the cache bumps itself whenever the token changes
+        """
+        self.lock = threading.Lock()
+        # Keeps ETags of different processes and restarts from colliding
+        self.instance = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.source = source
+        self.token = None
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def bump(self):
+        """
+        Invalidates every cached response and ETag after the data changed
+        """
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
+    def sync(self):
+        """
+        Bumps the version when the source token changed since the last request
+        """
+        if self.source is None:
+            return
+        token = self.source()
+        with self.lock:
+            if token != self.token:
+                self.token = token
+                self.version += 1
+                self.entries.clear()
+
+    def etag(self, key):
+        """
+        Returns the ETag of the response for key at the current version
+        """
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return 'W/"%s-%d-%s"' % (self.instance, self.version, digest)
+
+    @staticmethod
+    def encoding():
+        """
+        Returns the best encoding the client accepts: br, gzip or identity
+        """
+        accepted = request.accept_encodings
+        if brotli is not None and accepted["br"]:
+            return "br"
+        if accepted["gzip"]:
+            return "gzip"
+        return "identity"
+
+    def respond(self, etag, bodies):
+        """
+        Returns a Response with the body in the client's encoding, compressing
+        and memoizing it in bodies on first use
+        """
+        encoding = self.encoding()
+        if len(bodies["identity"]) < COMPRESS_MIN_SIZE:
+            encoding = "identity"
+        body = bodies.get(encoding)
+        if body is None:
+            if encoding == "br":
+                body = brotli.compress(bodies["identity"], quality=BROTLI_QUALITY)
+            else:
+                body = gzip.compress(bodies["identity"], compresslevel=GZIP_LEVEL)
+            bodies[encoding] = body
+        response = Response(body, 200, mimetype="application/json")
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["Vary"] = "Accept-Encoding"
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    def lookup(self):
+        """
+        Returns a 304 or cached Response for the current request, or None
+        when the route has to run
+        """
+        self.sync()
+        key = request.full_path
+        with self.lock:
+            etag = self.etag(key)
+            bodies = self.entries.get(key)
+            if bodies is not None:
+                self.entries.move_to_end(key)
+        if etag in request.headers.get("If-None-Match", ""):
+            self.not_modified += 1
+            response = Response(status=304)
+            response.headers["ETag"] = etag
+            return response
+        if bodies is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.respond(etag, bodies)
+
+    def store(self, body, version):
+        """
+        Caches the JSON body, str or bytes, of the current request computed at version and returns its Response
+        """
+        key = request.full_path
+        bodies = {"identity": body if isinstance(body, bytes) else body.encode()}
+        with self.lock:
+            # A body computed before a bump is served once but not cached
+            current = version == self.version
+            if current:
+                self.entries[key] = bodies
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            etag = self.etag(key)
+        if not current:
+            return Response(body, 200, mimetype="application/json")
+        return self.respond(etag, bodies)
+
+    def stats(self):
+        """
+        Returns the version, size and hit counters of the cache
+        """
+        with self.lock:
+            return {
+                "version": self.version,
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified
+            }
+
+
+def cached_by(cache):
+    """
+    Decorator answering a read route from cache before it runs. The route
+    opts in to storing by passing cache to success_response
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = cache.lookup()
+            if response is not None:
+                return response
+            g.cache_version = cache.version
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,139 @@
+from sqlalchemy.dialects.sqlite import insert
+from db import db, Message, Conversation
+
+PREVIEW_LENGTH = 200
+
+REBUILD_CONVERSATIONS = """
+INSERT INTO conversations (user_a_id, user_b_id, last_message_id, last_preview,
+                           last_sent_at, unread_a, unread_b, read_a_id, read_b_id)
+SELECT user_a_id, user_b_id, id, substr(content, 1, :preview), sent_at, 0, 0, id, id
+FROM (
+    SELECT min(sender_id, receiver_id) AS user_a_id, max(sender_id, receiver_id) AS user_b_id,
+           id, content, sent_at,
+           row_number() OVER (
+               PARTITION BY min(sender_id, receiver_id), max(sender_id, receiver_id)
+               ORDER BY sent_at DESC, id DESC
+           ) AS position
+    FROM messages
+)
+WHERE position = 1
+"""
+
+def pair(user_1, user_2):
+    """
+    Returns the (user_a_id, user_b_id) key of the conversation between two users
+    """
+    return min(user_1, user_2), max(user_1, user_2)
+
+def side(conversation, user_id):
+    """
+    Returns "a" or "b", the columns of conversation that belong to user_id
+    """
+    return "a" if user_id == conversation.user_a_id else "b"
+
+def find_conversation(user_1, user_2):
+    """
+    Returns the summary row of the conversation between two users, or None
+    """
+    user_a_id, user_b_id = pair(user_1, user_2)
+    return Conversation.query.filter_by(user_a_id=user_a_id, user_b_id=user_b_id).first()
+
+def record_message(message):
+    """
+    Makes a flushed message the last one of its conversation and counts it as
+    unread for the receiver. Runs in the caller's transaction
+    """
+    user_a_id, user_b_id = pair(message.sender_id, message.receiver_id)
+    to_a = int(message.receiver_id == user_a_id)
+    unread = Conversation.unread_a if to_a else Conversation.unread_b
+    stmt = insert(Conversation).values(
+        user_a_id=user_a_id,
+        user_b_id=user_b_id,
+        last_message_id=message.id,
+        last_preview=message.content[:PREVIEW_LENGTH],
+        last_sent_at=message.sent_at,
+        unread_a=to_a,
+        unread_b=1 - to_a
+    )
+    # One statement, so two first messages racing for a new pair cannot both insert
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_a_id", "user_b_id"],
+        set_={
+            "last_message_id": stmt.excluded.last_message_id,
+            "last_preview": stmt.excluded.last_preview,
+            "last_sent_at": stmt.excluded.last_sent_at,
+            unread.key: unread + 1
+        }
+    )
+    db.session.execute(stmt)
+
+def latest_message(user_1, user_2, exclude_id):
+    """
+    Returns the newest message between two users other than exclude_id, using
+    one index range scan per direction
+    """
+    latest = None
+    for sender, receiver in {(user_1, user_2), (user_2, user_1)}:
+        message = Message.query.filter(
+            Message.sender_id == sender,
+            Message.receiver_id == receiver,
+            Message.id != exclude_id
+        ).order_by(Message.sent_at.desc(), Message.id.desc()).first()
+        if message and (latest is None or (message.sent_at, message.id) > (latest.sent_at, latest.id)):
+            latest = message
+    return latest
+
+def unrecord_message(message):
+    """
+    Removes a message that is about to be deleted from its conversation's
+    summary. Runs in the caller's transaction
+    """
+    conversation = find_conversation(message.sender_id, message.receiver_id)
+    if conversation is None:
+        return
+    receiver = side(conversation, message.receiver_id)
+    read_id = getattr(conversation, "read_%s_id" % receiver)
+    unread = getattr(conversation, "unread_" + receiver)
+    if unread > 0 and (read_id is None or message.id > read_id):
+        setattr(conversation, "unread_" + receiver, unread - 1)
+    if conversation.last_message_id != message.id:
+        return
+    previous = latest_message(message.sender_id, message.receiver_id, message.id)
+    if previous is None:
+        db.session.delete(conversation)
+        return
+    conversation.last_message_id = previous.id
+    conversation.last_preview = previous.content[:PREVIEW_LENGTH]
+    conversation.last_sent_at = previous.sent_at
+
+def mark_read(user_id, friend_id):
+    """
+    Marks every message user_id received from friend_id as read, returns the
+    conversation or None when they never exchanged messages
+    """
+    conversation = find_conversation(user_id, friend_id)
+    if conversation is None:
+        return None
+    reader = side(conversation, user_id)
+    setattr(conversation, "unread_" + reader, 0)
+    setattr(conversation, "read_%s_id" % reader, conversation.last_message_id)
+    return conversation
+
+def list_conversations(user_id):
+    """
+    Returns the conversations of a user, most recent first
+    """
+    return Conversation.query.filter(
+        (Conversation.user_a_id == user_id) | (Conversation.user_b_id == user_id)
+    ).order_by(Conversation.last_sent_at.desc(), Conversation.last_message_id.desc()).all()
+
+def rebuild_conversations():
+    """
+    Fills an empty conversations table from the messages table in one
+    statement. Existing history counts as read, since read state was never stored
+    """
+    if Conversation.query.first() is not None or Message.query.first() is None:
+        return
+    db.session.execute(db.text(REBUILD_CONVERSATIONS), {"preview": PREVIEW_LENGTH})
+    db.session.commit()
+    print("Rebuilt", Conversation.query.count(), "conversations")
@@ -0,0 +1,400 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from db import db, User, Session, Interest, user_interest_table, user_session_table
+
+MAJOR_WEIGHT = 30
+INTEREST_WEIGHT = 15
+CATEGORY_WEIGHT = 5
+TOP_MATCHES = 10
+MATCH_CACHE_SIZE = 1024
+
+# Number of set bits for every possible byte value, used to popcount bitsets
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int32)
+EMPTY_IDS = np.zeros(0, dtype=np.int64)
+
+class MatchEngine:
+    """
+    Keeps per-user major ids and interest/category bitsets so that every
+    candidate of a match request can be scored in one batched NumPy pass
+    """
+    def __init__(self):
+        """
+        Initializes an empty engine, call build() to load it from the database
+        """
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.majors = np.zeros(0, dtype=np.int64)
+        self.interests = np.zeros((0, 1), dtype=np.uint8)
+        self.categories = np.zeros((0, 1), dtype=np.uint8)
+        self.interest_bits = {}
+        self.category_bits = {}
+
+    def build(self):
+        """
+        Loads the features of every user from the database, must run inside an app context
+        """
+        user_rows = db.session.query(User.id, User.major_id).all()
+        interest_rows = db.session.query(
+            user_interest_table.c.user_id, Interest.id, Interest.category_id
+        ).join(Interest, Interest.id == user_interest_table.c.interest_id).all()
+        features = {user_id: (major_id, []) for user_id, major_id in user_rows}
+        for user_id, interest_id, category_id in interest_rows:
+            if user_id in features:
+                features[user_id][1].append((interest_id, category_id))
+        with self.lock:
+            self.rows = {}
+            self.majors = np.zeros(len(features), dtype=np.int64)
+            self.interests = np.zeros((len(features), 1), dtype=np.uint8)
+            self.categories = np.zeros((len(features), 1), dtype=np.uint8)
+            self.interest_bits = {}
+            self.category_bits = {}
+            for user_id, (major_id, interests) in features.items():
+                self.set_features(user_id, major_id, interests)
+
+    def update_user(self, user):
+        """
+        Refreshes the stored features of a user after its major or interests change
+        """
+        interests = [(i.id, i.category_id) for i in user.interests]
+        with self.lock:
+            self.set_features(user.id, user.major_id, interests)
+
+    def remove_user(self, user_id):
+        """
+        Clears the stored features of a deleted user
+        """
+        with self.lock:
+            row = self.rows.get(user_id)
+            if row is not None:
+                self.majors[row] = 0
+                self.interests[row] = 0
+                self.categories[row] = 0
+
+    def set_features(self, user_id, major_id, interests):
+        """
+        Writes the major id and interest/category bits of a user, caller holds the lock
+        """
+        row = self.rows.get(user_id)
+        if row is None:
+            row = len(self.rows)
+            self.rows[user_id] = row
+            if row >= len(self.majors):
+                size = max(16, 2 * len(self.majors))
+                self.majors = np.resize(self.majors, size)
+                self.interests = self.grow_rows(self.interests, size)
+                self.categories = self.grow_rows(self.categories, size)
+        self.majors[row] = major_id or 0
+        self.interests[row] = 0
+        self.categories[row] = 0
+        for interest_id, category_id in interests:
+            self.interests = self.set_bit(self.interests, self.interest_bits, row, interest_id)
+            self.categories = self.set_bit(self.categories, self.category_bits, row, category_id)
+
+    @staticmethod
+    def grow_rows(bits, size):
+        """
+        Returns a copy of a bitset matrix padded with empty rows up to size
+        """
+        grown = np.zeros((size, bits.shape[1]), dtype=np.uint8)
+        grown[:bits.shape[0]] = bits
+        return grown
+
+    @staticmethod
+    def set_bit(bits, positions, row, key):
+        """
+        Sets the bit assigned to key in the given row, widening the matrix when needed
+        """
+        position = positions.setdefault(key, len(positions))
+        byte, offset = divmod(position, 8)
+        if byte >= bits.shape[1]:
+            widened = np.zeros((bits.shape[0], max(byte + 1, 2 * bits.shape[1])), dtype=np.uint8)
+            widened[:, :bits.shape[1]] = bits
+            bits = widened
+        bits[row, byte] |= np.uint8(1 << offset)
+        return bits
+
+    def score(self, user_id, candidate_ids):
+        """
+        Returns the scores of the candidates against the user as an array aligned with candidate_ids
+        """
+        candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+        with self.lock:
+            row = self.rows.get(user_id)
+            if row is None or len(candidate_ids) == 0:
+                return np.zeros(len(candidate_ids), dtype=np.int64)
+            lookup = np.array([self.rows.get(int(c), -1) for c in candidate_ids], dtype=np.int64)
+            known = lookup >= 0
+            rows = lookup[known]
+            major = self.majors[row]
+            majors = self.majors[rows]
+            interests = self.interests[rows] & self.interests[row]
+            categories = self.categories[rows] & self.categories[row]
+        common_interests = POPCOUNT[interests].sum(axis=1)
+        common_categories = POPCOUNT[categories].sum(axis=1)
+        scores = np.zeros(len(candidate_ids), dtype=np.int64)
+        scores[known] = (
+            MAJOR_WEIGHT * ((majors == major) & (major != 0))
+            + INTEREST_WEIGHT * common_interests
+            + CATEGORY_WEIGHT * np.maximum(0, common_categories - common_interests)
+        )
+        return scores
+
+    def top_matches(self, user_id, candidate_ids, k=TOP_MATCHES):
+        """
+        Returns (candidate id, score) pairs of the k best candidates, best first
+        """
+        candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+        scores = self.score(user_id, candidate_ids)
+        # Highest score first, ties keep the candidate order
+        order = np.arange(len(candidate_ids)) - scores * len(candidate_ids)
+        if len(candidate_ids) > k:
+            best = np.argpartition(order, k - 1)[:k]
+        else:
+            best = np.arange(len(candidate_ids))
+        best = best[np.argsort(order[best])]
+        return [(int(candidate_ids[i]), int(scores[i])) for i in best]
+
+
+class CandidateIndex:
+    """
+    Maps session ids and course ids to sorted arrays of enrolled user ids so
+    that candidate lookups need no ORM loads
+    """
+    def __init__(self):
+        """
+        Initializes an empty index, call build() to load it from the database
+        """
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.courses = {}
+        self.course_sessions = {}
+        self.session_course = {}
+
+    def build(self):
+        """
+        Loads every enrollment from user_session_association, must run inside an app context.
+        Rows left behind by deleted users or sessions are skipped
+        """
+        rows = db.session.query(
+            user_session_table.c.session_id, Session.course_id, user_session_table.c.user_id
+        ).join(Session, Session.id == user_session_table.c.session_id
+        ).join(User, User.id == user_session_table.c.user_id).all()
+        members = {}
+        session_course = {}
+        for session_id, course_id, user_id in rows:
+            members.setdefault(session_id, []).append(user_id)
+            session_course[session_id] = course_id
+        with self.lock:
+            self.sessions = {sid: np.unique(np.array(ids, dtype=np.int64)) for sid, ids in members.items()}
+            self.session_course = session_course
+            self.course_sessions = {}
+            for session_id, course_id in session_course.items():
+                self.course_sessions.setdefault(course_id, set()).add(session_id)
+            self.courses = {}
+            for course_id in self.course_sessions:
+                self.refresh_course(course_id)
+
+    def refresh_course(self, course_id):
+        """
+        Rebuilds the user array of a course from its session arrays, caller holds the lock
+        """
+        session_ids = self.course_sessions.get(course_id)
+        if not session_ids:
+            self.course_sessions.pop(course_id, None)
+            self.courses.pop(course_id, None)
+            return
+        self.courses[course_id] = np.unique(np.concatenate([self.sessions[s] for s in session_ids]))
+
+    def add(self, user_id, session_id, course_id):
+        """
+        Records that a user added a session of a course to their schedule
+        """
+        with self.lock:
+            ids = self.sessions.get(session_id, EMPTY_IDS)
+            self.sessions[session_id] = np.union1d(ids, np.array([user_id], dtype=np.int64))
+            self.session_course[session_id] = course_id
+            self.course_sessions.setdefault(course_id, set()).add(session_id)
+            self.refresh_course(course_id)
+
+    def remove(self, user_id, session_id):
+        """
+        Records that a user removed a session from their schedule
+        """
+        with self.lock:
+            ids = self.sessions.get(session_id)
+            if ids is None:
+                return
+            course_id = self.session_course.get(session_id)
+            ids = ids[ids != user_id]
+            if len(ids):
+                self.sessions[session_id] = ids
+            else:
+                self.drop_session(session_id)
+            self.refresh_course(course_id)
+
+    def remove_sessions(self, session_ids):
+        """
+        Forgets deleted sessions
+        """
+        with self.lock:
+            courses = {self.session_course.get(s) for s in session_ids}
+            for session_id in session_ids:
+                self.drop_session(session_id)
+            for course_id in courses:
+                self.refresh_course(course_id)
+
+    def remove_user(self, user_id, session_ids):
+        """
+        Forgets a deleted user in every session they were enrolled in
+        """
+        for session_id in session_ids:
+            self.remove(user_id, session_id)
+
+    def drop_session(self, session_id):
+        """
+        Removes a session from every map except the course arrays, caller holds the lock
+        """
+        self.sessions.pop(session_id, None)
+        course_id = self.session_course.pop(session_id, None)
+        if course_id in self.course_sessions:
+            self.course_sessions[course_id].discard(session_id)
+
+    def students_in_sessions(self, session_ids):
+        """
+        Returns the sorted ids of users enrolled in any of the sessions
+        """
+        with self.lock:
+            arrays = [self.sessions[s] for s in session_ids if s in self.sessions]
+        if not arrays:
+            return EMPTY_IDS
+        return np.unique(np.concatenate(arrays))
+
+    def students_in_course(self, course_id):
+        """
+        Returns the sorted ids of users enrolled in any session of the course
+        """
+        with self.lock:
+            return self.courses.get(course_id, EMPTY_IDS)
+
+
+class MatchCache:
+    """
+    Bounded LRU cache of match results keyed by (user, course, session set)
+    """
+    def __init__(self, maxsize=MATCH_CACHE_SIZE):
+        """
+        Initializes an empty cache holding at most maxsize results
+        """
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.by_session = {}
+        self.by_user = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    @staticmethod
+    def key(user_id, course_code, session_ids):
+        """
+        Returns the cache key of a match request, the order of session ids does not matter
+        """
+        return (user_id, course_code, frozenset(session_ids or ()))
+
+    def get(self, key):
+        """
+        Returns the cached result for key, or None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, session_ids, result, generation):
+        """
+        Stores the result of a request that drew its candidates from session_ids
+
+        generation is the value of self.generation read before the result was
+        computed, the result is dropped if an invalidation happened since then
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            if key in self.entries:
+                self.discard(key)
+            self.entries[key] = (result, frozenset(session_ids))
+            for session_id in session_ids:
+                self.by_session.setdefault(session_id, set()).add(key)
+            self.by_user.setdefault(key[0], set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self.discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def discard(self, key):
+        """
+        Removes one entry and its reverse index references, caller holds the lock
+        """
+        result, session_ids = self.entries.pop(key)
+        for session_id in session_ids:
+            keys = self.by_session.get(session_id)
+            keys.discard(key)
+            if not keys:
+                del self.by_session[session_id]
+        keys = self.by_user.get(key[0])
+        keys.discard(key)
+        if not keys:
+            del self.by_user[key[0]]
+
+    def invalidate_sessions(self, session_ids):
+        """
+        Drops every result whose candidates were drawn from one of the sessions
+        """
+        with self.lock:
+            self.generation += 1
+            for session_id in session_ids:
+                for key in list(self.by_session.get(session_id, ())):
+                    self.discard(key)
+                    self.invalidations += 1
+
+    def invalidate_user(self, user_id, session_ids=()):
+        """
+        Drops the results requested by a user and those where the user is a candidate
+        """
+        with self.lock:
+            self.generation += 1
+            for key in list(self.by_user.get(user_id, ())):
+                self.discard(key)
+                self.invalidations += 1
+        self.invalidate_sessions(session_ids)
+
+    def clear(self):
+        """
+        Drops every result, e.g. after a roster sync changed which sessions a course has
+        """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.by_session = {}
+            self.by_user = {}
+
+    def stats(self):
+        """
+        Returns the size and hit/miss counters of the cache
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
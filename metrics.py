@@ -0,0 +1,223 @@
+import sys
+import time
+import bisect
+import threading
+from flask import g, request, Response
+
+# Upper bounds in seconds, from 0.25ms doubling up to about 16s
+LATENCY_BUCKETS = [0.00025 * 2 ** i for i in range(17)]
+QUANTILES = [0.5, 0.95, 0.99]
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HELP = {
+    "http_request_duration_seconds": ("histogram", "Latency of HTTP requests by endpoint"),
+    "http_requests_total": ("counter", "HTTP requests by endpoint, method and status code"),
+    "http_request_bytes_total": ("counter", "Bytes received in HTTP request bodies by endpoint"),
+    "http_response_bytes_total": ("counter", "Bytes sent in HTTP response bodies by endpoint"),
+    "websocket_action_duration_seconds": ("histogram", "Latency of WebSocket actions"),
+    "websocket_actions_total": ("counter", "WebSocket actions by outcome"),
+    "websocket_message_bytes_total": ("counter", "Bytes received in WebSocket messages by action"),
+}
+
+class Histogram:
+    """
+    Counts of observations per latency bucket, with their sum
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Initializes an empty histogram over the given upper bounds
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Adds one observation, caller holds the registry lock
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimates the q quantile by interpolating inside its bucket, like Prometheus' histogram_quantile
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def format_labels(labels):
+    """
+    Returns labels, a tuple of (name, value) pairs, in Prometheus syntax
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+class MetricsRegistry:
+    """
+    In-process counters and latency histograms rendered in the Prometheus text format
+    """
+    def __init__(self):
+        """
+        Initializes a registry without metrics
+        """
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, labels, seconds):
+        """
+        Adds a latency observation to the histogram name{labels}
+        """
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, labels, amount=1):
+        """
+        Adds amount to the counter name{labels}
+        """
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format. Each
+        histogram also gets a <name>_quantile gauge with its estimated p50, p95 and p99
+        """
+        with self.lock:
+            histograms = [(key, list(h.counts), h.sum, h.count, [h.quantile(q) for q in QUANTILES])
+                          for key, h in self.histograms.items()]
+            counters = list(self.counters.items())
+        lines = []
+        described = set()
+        def describe(name, kind=None, text=None):
+            if name in described:
+                return
+            described.add(name)
+            default_kind, default_text = HELP.get(name, ("untyped", name))
+            lines.append("# HELP %s %s" % (name, text or default_text))
+            lines.append("# TYPE %s %s" % (name, kind or default_kind))
+        for (name, labels), counts, total, count, quantiles in sorted(histograms):
+            describe(name)
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + [float("inf")], counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", le),)), cumulative))
+            lines.append("%s_sum%s %r" % (name, format_labels(labels), total))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+        for (name, labels), counts, total, count, quantiles in sorted(histograms):
+            describe(name + "_quantile", "gauge", "Estimated quantiles of " + name)
+            for q, value in zip(QUANTILES, quantiles):
+                lines.append("%s_quantile%s %r" % (name, format_labels(labels + (("quantile", q),)), value))
+        for (name, labels), value in sorted(counters):
+            describe(name)
+            lines.append("%s%s %d" % (name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def response(self):
+        """
+        Returns a Flask response with the rendered metrics
+        """
+        return Response(self.render(), mimetype=PROMETHEUS_CONTENT_TYPE)
+
+
+def init_app(app, registry):
+    """
+    Records the latency, status code and body sizes of every request of app in registry
+    """
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        endpoint = request.endpoint or "<unmatched>"
+        labels = (("endpoint", endpoint),)
+        registry.observe("http_request_duration_seconds", labels, time.perf_counter() - start)
+        registry.inc("http_requests_total", labels + (("method", request.method), ("code", response.status_code)))
+        if request.content_length:
+            registry.inc("http_request_bytes_total", labels, request.content_length)
+        if response.content_length:
+            registry.inc("http_response_bytes_total", labels, response.content_length)
+        return response
+
+
+def benchmark(iterations=100000, rounds=40, batch=500):
+    """
+    Measures the cost of one observation and the overhead of init_app on a
+    trivial route. Plain and instrumented batches run interleaved, in
+    alternating order, and the overhead is reported as the median and spread
+    of the paired per-round differences, so drift and noise between rounds cancel out
+    """
+    registry = MetricsRegistry()
+    labels = (("endpoint", "bench"),)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        registry.observe("http_request_duration_seconds", labels, 0.003)
+        registry.inc("http_requests_total", labels)
+    per_call = (time.perf_counter() - start) / iterations
+    print("observe + inc: %.0fns per request" % (per_call * 1e9))
+
+    import gc
+    import statistics
+    from flask import Flask
+    def make_app(instrumented):
+        app = Flask("bench")
+        @app.route("/")
+        def index():
+            return "ok"
+        if instrumented:
+            init_app(app, MetricsRegistry())
+        return app.test_client()
+    clients = {False: make_app(False), True: make_app(True)}
+    def run(client):
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(batch):
+            client.get("/")
+        return (time.perf_counter() - start) / batch
+    for client in clients.values():
+        run(client)
+    plain, extra = [], []
+    for i in range(rounds):
+        order = [False, True] if i % 2 == 0 else [True, False]
+        timings = {instrumented: run(clients[instrumented]) for instrumented in order}
+        plain.append(timings[False])
+        extra.append(timings[True] - timings[False])
+    def spread(values):
+        deciles = statistics.quantiles(values, n=10)
+        return statistics.median(values), deciles[0], deciles[-1]
+    median, low, high = spread([p * 1e6 for p in plain])
+    print("trivial route: %.1fus per request (p10 %.1fus, p90 %.1fus), %d rounds of %d requests" % (
+        median, low, high, rounds, batch))
+    median, low, high = spread([e * 1e6 for e in extra])
+    print("instrumentation: +%.2fus per request (p10 %+.2fus, p90 %+.2fus)" % (median, low, high))
+    median, low, high = spread([100 * e / p for e, p in zip(extra, plain)])
+    print("overhead: %.1f%% median (p10 %.1f%%, p90 %.1f%%)" % (median, low, high))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
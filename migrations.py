@@ -0,0 +1,186 @@
+from datetime import datetime
+from sqlalchemy import inspect, select, or_
+from sqlalchemy.dialects import sqlite
+from db import db, User, Course, Session, Friend, Message, Interest, Conversation, user_session_table, user_interest_table
+
+CREATE_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR NOT NULL,
+    applied_at DATETIME NOT NULL
+)
+"""
+
+HOT_PATH_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_sender_receiver_sent_at ON messages (sender_id, receiver_id, sent_at)",
+    "CREATE INDEX IF NOT EXISTS ix_friends_user_friend_status ON friends (user_id, friend_id, status)",
+    "CREATE INDEX IF NOT EXISTS ix_friends_friend_status ON friends (friend_id, status)",
+    "CREATE INDEX IF NOT EXISTS ix_interests_name_category ON interests (name, category_id)",
+    "CREATE INDEX IF NOT EXISTS ix_sessions_course_id ON sessions (course_id)",
+]
+
+# Association tables rebuilt with a composite primary key: (table, key
+# columns, referenced tables, reverse index). Duplicate and NULL rows are
+# dropped, and so are rows left behind by deleted rows of the referenced tables
+ASSOCIATION_TABLES = [
+    ("user_session_association", ("session_id", "user_id"), ("sessions", "users"), "ix_user_session_user_session"),
+    ("user_interest_association", ("user_id", "interest_id"), ("users", "interests"), "ix_user_interest_interest_user"),
+]
+
+def add_hot_path_indexes(connection):
+    """
+    Indexes the columns the friend, message, interest and session lookups filter on
+    """
+    for statement in HOT_PATH_INDEXES:
+        connection.exec_driver_sql(statement)
+
+def add_association_primary_keys(connection):
+    """
+    Rebuilds the association tables with a composite primary key and a reverse index
+    """
+    for table, (first, second), (first_ref, second_ref), reverse_index in ASSOCIATION_TABLES:
+        connection.exec_driver_sql(
+            "CREATE TABLE %s_new (%s INTEGER NOT NULL REFERENCES %s (id), "
+            "%s INTEGER NOT NULL REFERENCES %s (id), PRIMARY KEY (%s, %s))"
+            % (table, first, first_ref, second, second_ref, first, second)
+        )
+        connection.exec_driver_sql(
+            "INSERT OR IGNORE INTO %s_new (%s, %s) SELECT %s, %s FROM %s "
+            "WHERE %s IN (SELECT id FROM %s) AND %s IN (SELECT id FROM %s)"
+            % (table, first, second, first, second, table, first, first_ref, second, second_ref)
+        )
+        connection.exec_driver_sql("DROP TABLE %s" % table)
+        connection.exec_driver_sql("ALTER TABLE %s_new RENAME TO %s" % (table, table))
+        connection.exec_driver_sql("CREATE INDEX %s ON %s (%s, %s)" % (reverse_index, table, second, first))
+
+FRIEND_PAIRS = [
+    "ALTER TABLE friends ADD COLUMN pair_low INTEGER",
+    "ALTER TABLE friends ADD COLUMN pair_high INTEGER",
+    "UPDATE friends SET pair_low = min(user_id, friend_id), pair_high = max(user_id, friend_id)",
+    # Keep one row per pair, an accepted friendship over a pending request, then the oldest
+    """DELETE FROM friends WHERE id NOT IN (
+        SELECT id FROM (
+            SELECT id, row_number() OVER (
+                PARTITION BY pair_low, pair_high ORDER BY status = 'Accepted' DESC, id
+            ) AS position
+            FROM friends
+        ) WHERE position = 1
+    )""",
+    "CREATE UNIQUE INDEX uq_friends_pair ON friends (pair_low, pair_high)",
+]
+
+def add_friend_pairs(connection):
+    """
+    Adds the canonical pair key to friends, merging duplicate pairs, and makes it unique
+    """
+    for statement in FRIEND_PAIRS:
+        connection.exec_driver_sql(statement)
+
+def drop_orphan_associations(connection):
+    """
+    Deletes association rows whose user, session or interest no longer
+    exists, for databases keyed before migration 2 dropped them
+    """
+    for table, (first, second), (first_ref, second_ref), _ in ASSOCIATION_TABLES:
+        connection.exec_driver_sql(
+            "DELETE FROM %s WHERE %s NOT IN (SELECT id FROM %s) OR %s NOT IN (SELECT id FROM %s)"
+            % (table, first, first_ref, second, second_ref)
+        )
+
+def add_message_page_index(connection):
+    """
+    Indexes the messages of each sender and receiver by id, the key of message history pages
+    """
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_messages_sender_receiver_id ON messages (sender_id, receiver_id, id)"
+    )
+
+# Applied in order, each in its own transaction. Append new migrations here
+# and never renumber or edit one that has shipped
+MIGRATIONS = [
+    (1, "hot path indexes", add_hot_path_indexes),
+    (2, "association primary keys", add_association_primary_keys),
+    (3, "friend pair key", add_friend_pairs),
+    (4, "orphan association rows", drop_orphan_associations),
+    (5, "message page index", add_message_page_index),
+]
+
+def migrate():
+    """
+    Creates missing tables and applies pending migrations, must run inside an
+    app context. A new database already has the current schema from
+    create_all, so its migrations are only recorded
+    """
+    fresh = not inspect(db.engine).has_table("users")
+    db.create_all()
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql(CREATE_MIGRATIONS_TABLE)
+        applied = {row[0] for row in connection.exec_driver_sql("SELECT version FROM schema_migrations")}
+        connection.commit()
+        for version, name, upgrade in MIGRATIONS:
+            if version in applied:
+                continue
+            # pysqlite does not open a transaction before DDL on its own
+            connection.exec_driver_sql("BEGIN")
+            if not fresh:
+                upgrade(connection)
+            connection.exec_driver_sql(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.utcnow().isoformat(" "))
+            )
+            connection.commit()
+            if not fresh:
+                print("Applied migration", version, name)
+
+def plan_checks():
+    """
+    Returns the main query of each hot route as (name, statement, indexes),
+    where indexes are the indexes its plan must use
+    """
+    return [
+        ("get_user", select(User).where(User.id == 1), ["INTEGER PRIMARY KEY"]),
+        ("get_friends sent", select(Friend).where(Friend.user_id == 1, Friend.status == "Accepted"),
+         ["ix_friends_user_friend_status"]),
+        ("get_friends received", select(Friend).where(Friend.friend_id == 1, Friend.status == "Accepted"),
+         ["ix_friends_friend_status"]),
+        ("send_friend_request", select(Friend).where(Friend.pair_low == 1, Friend.pair_high == 2),
+         ["uq_friends_pair"]),
+        ("get_course", select(Course).where(Course.id == 1), ["INTEGER PRIMARY KEY"]),
+        ("get_course sessions", select(Session).where(Session.course_id == 1), ["ix_sessions_course_id"]),
+        ("match_buddy course", select(Course).where(Course.code == "CS1110"), ["sqlite_autoindex_courses"]),
+        ("get_session students", select(user_session_table).where(user_session_table.c.session_id == 1),
+         ["sqlite_autoindex_user_session_association"]),
+        ("get_schedule", select(user_session_table).where(user_session_table.c.user_id == 1),
+         ["ix_user_session_user_session"]),
+        ("get_user interests", select(user_interest_table).where(user_interest_table.c.user_id == 1),
+         ["sqlite_autoindex_user_interest_association"]),
+        ("get_interest users", select(user_interest_table).where(user_interest_table.c.interest_id == 1),
+         ["ix_user_interest_interest_user"]),
+        ("update_user interest", select(Interest).where(Interest.name == "Chess", Interest.category_id == 1),
+         ["sqlite_autoindex_interests"]),
+        ("get_conversation", select(Message).where(
+            Message.sender_id == 1, Message.receiver_id == 2, Message.id < 100
+        ).order_by(Message.id.desc()), ["ix_messages_sender_receiver_id"]),
+        ("get_inbox_preview", select(Conversation).where(
+            or_(Conversation.user_a_id == 1, Conversation.user_b_id == 1)
+        ).order_by(Conversation.last_sent_at.desc(), Conversation.last_message_id.desc()),
+         ["ix_conversations_user_a_sent_at", "ix_conversations_user_b_sent_at"]),
+    ]
+
+def check_query_plans():
+    """
+    Runs EXPLAIN QUERY PLAN on each route's main query, returns
+    (name, uses_index, plan) where uses_index is False if any table is
+    scanned in full or one of the query's indexes is not used.
+    tests/test_migrations.py fails on any such query
+    """
+    results = []
+    with db.engine.connect() as connection:
+        for name, statement, indexes in plan_checks():
+            sql = str(statement.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+            plan = [row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+            uses_index = not any(step.startswith("SCAN ") for step in plan) and all(
+                any(index in step for step in plan) for index in indexes
+            )
+            results.append((name, uses_index, plan))
+    return results
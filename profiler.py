@@ -0,0 +1,206 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from flask import request
+
+# Seconds between samples, 5ms keeps the sampler under a few percent of one core
+SAMPLE_INTERVAL = 0.005
+MIN_SAMPLE_INTERVAL = 0.001
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 300
+
+def frame_name(code):
+    """
+    Returns the collapsed stack name of a code object: function (file:line)
+    """
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads serving requests with
+    sys._current_frames() from a background thread while a profile runs.
+    When no profile runs, the request hooks only read one attribute
+    """
+    def __init__(self):
+        """
+        Initializes an idle profiler
+        """
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.done.set()
+        self.active = False
+        self.threads = {}
+        self.stacks = Counter()
+        self.settings = {}
+        self.samples = 0
+        self.requests = 0
+        self.started = None
+        self.stopped = None
+
+    def init_app(self, app):
+        """
+        Tracks which thread serves which endpoint while a profile runs
+        """
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+    def before_request(self):
+        """
+        Marks the current thread as sampled when the endpoint matches the filter
+        """
+        if not self.active:
+            return
+        endpoint = self.settings.get("endpoint")
+        if endpoint is None or endpoint == request.endpoint:
+            self.threads[threading.get_ident()] = request.endpoint or "<unmatched>"
+
+    def teardown_request(self, exc):
+        """
+        Stops sampling the current thread and counts the request
+        """
+        if not self.active:
+            return
+        if self.threads.pop(threading.get_ident(), False) is False:
+            return
+        with self.lock:
+            self.requests += 1
+            limit = self.settings.get("requests")
+            if limit is not None and self.requests >= limit:
+                self.active = False
+
+    def start(self, seconds=DEFAULT_PROFILE_SECONDS, requests=None, endpoint=None, interval=SAMPLE_INTERVAL):
+        """
+        Starts sampling every interval seconds for up to seconds, or until
+        requests requests have finished, only in requests to endpoint if given.
+        Returns False if a profile is already running
+        """
+        with self.lock:
+            if self.active:
+                return False
+            self.settings = {
+                "seconds": min(seconds, MAX_PROFILE_SECONDS),
+                "requests": requests,
+                "endpoint": endpoint,
+                "interval": max(interval, MIN_SAMPLE_INTERVAL)
+            }
+            self.threads = {}
+            self.stacks = Counter()
+            self.samples = 0
+            self.requests = 0
+            self.started = time.time()
+            self.stopped = None
+            self.done.clear()
+            self.active = True
+        threading.Thread(target=self.run, daemon=True).start()
+        return True
+
+    def stop(self):
+        """
+        Ends the running profile
+        """
+        self.active = False
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the running profile ends or timeout seconds passed, returns whether it ended
+        """
+        return self.done.wait(timeout)
+
+    def run(self):
+        """
+        Takes samples until the profile ends
+        """
+        deadline = time.monotonic() + self.settings["seconds"]
+        interval = self.settings["interval"]
+        while self.active and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            collected = []
+            for thread_id, endpoint in list(self.threads.items()):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(endpoint)
+                collected.append(";".join(reversed(stack)))
+            del frames
+            with self.lock:
+                self.stacks.update(collected)
+                self.samples += len(collected)
+            time.sleep(interval)
+        with self.lock:
+            self.active = False
+            self.threads = {}
+            self.stopped = time.time()
+        self.done.set()
+
+    def status(self):
+        """
+        Returns whether a profile runs, its settings and how much it collected
+        """
+        with self.lock:
+            return {
+                "active": self.active,
+                "settings": self.settings,
+                "samples": self.samples,
+                "requests": self.requests,
+                "stacks": len(self.stacks),
+                "started": self.started,
+                "stopped": self.stopped
+            }
+
+    def collapsed(self):
+        """
+        Returns the samples as collapsed stacks, one "endpoint;outer;...;inner count"
+        line per stack, the input format of flamegraph.pl and speedscope
+        """
+        with self.lock:
+            stacks = self.stacks.most_common()
+        return "".join("%s %d\n" % (stack, count) for stack, count in stacks)
+
+
+def benchmark(requests=5000):
+    """
+    Measures the overhead of an installed profiler on a trivial route while it is off and while it samples
+    """
+    from flask import Flask
+    def make_app(profiler):
+        app = Flask("bench")
+        @app.route("/")
+        def index():
+            return "ok"
+        if profiler is not None:
+            profiler.init_app(app)
+        return app.test_client()
+    timings = {}
+    for mode in ["plain", "off", "on"] * 2:
+        profiler = None if mode == "plain" else SamplingProfiler()
+        client = make_app(profiler)
+        for _ in range(200):
+            client.get("/")
+        if mode == "on":
+            profiler.start(seconds=60)
+        start = time.perf_counter()
+        for _ in range(requests):
+            client.get("/")
+        timings.setdefault(mode, []).append((time.perf_counter() - start) / requests)
+        if mode == "on":
+            profiler.stop()
+            profiler.wait()
+            samples = profiler.samples
+    plain = min(timings["plain"])
+    print("trivial route: %.1fus plain" % (plain * 1e6))
+    for mode in ["off", "on"]:
+        elapsed = min(timings[mode])
+        print("profiler %-3s: %.1fus, %.1fus (%.1f%%) overhead" % (
+            mode, elapsed * 1e6, (elapsed - plain) * 1e6, 100 * (elapsed - plain) / plain))
+    print("last profile: %d samples" % samples)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
@@ -0,0 +1,184 @@
+import re
+import heapq
+import threading
+from bisect import bisect_left
+import numpy as np
+from db import db, Course, Session, user_session_table
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MIN_TRIGRAM_OVERLAP = 0.6
+
+EXACT_CODE_SCORE = 1000
+CODE_PREFIX_SCORE = 500
+CODE_MATCH_SCORE = 300
+NAME_WORD_SCORE = 200
+NAME_MATCH_SCORE = 100
+TRIGRAM_SCORE = 100
+
+TYPEAHEAD_LIMIT = 10
+MAX_TYPEAHEAD_LIMIT = 20
+# Prefixes up to this length have their top results precomputed
+TYPEAHEAD_DEPTH = 3
+
+def normalize(text):
+    """
+    Lowercases text and keeps only letters, digits and single spaces
+    """
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text.lower()).split())
+
+def compact(text):
+    """
+    Normalizes text and removes the spaces, so "CS 2110" and "cs2110" compare equal
+    """
+    return normalize(text).replace(" ", "")
+
+def trigrams(text):
+    """
+    Returns the set of 3 character substrings of text
+    """
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+class CourseSearchIndex:
+    """
+    In-process trigram index over course codes and names returning relevance ranked results
+    """
+    def __init__(self):
+        """
+        Initializes an empty index, call build() to load it from the database
+        """
+        self.lock = threading.Lock()
+        self.data = ([], {})
+        self.removed = set()
+
+    def build(self):
+        """
+        Rebuilds the index from the courses table and swaps it in, must run inside an app context
+        """
+        docs = []
+        grams = {}
+        for course_id, code, name in db.session.query(Course.id, Course.code, Course.name).order_by(Course.id):
+            doc = len(docs)
+            docs.append((course_id, code, name, compact(code), normalize(name), compact(name)))
+            for gram in trigrams(compact(code)) | trigrams(compact(name)):
+                grams.setdefault(gram, []).append(doc)
+        postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in grams.items()}
+        with self.lock:
+            self.data = (docs, postings)
+            self.removed = set()
+
+    def discard(self, course_id):
+        """
+        Hides a deleted course until the next rebuild
+        """
+        with self.lock:
+            self.removed.add(course_id)
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        Returns (course id, code, name) tuples matching query, most relevant first
+        """
+        with self.lock:
+            docs, postings = self.data
+            removed = set(self.removed)
+        words = normalize(query)
+        query = compact(query)
+        query_grams = trigrams(query)
+        if not query_grams or not docs:
+            return []
+        lists = [postings[g] for g in query_grams if g in postings]
+        if not lists:
+            return []
+        counts = np.bincount(np.concatenate(lists), minlength=len(docs))
+        needed = max(1, int(np.ceil(MIN_TRIGRAM_OVERLAP * len(query_grams))))
+        ranked = []
+        for doc in np.flatnonzero(counts >= needed):
+            course_id, code, name, code_key, name_key, name_compact = docs[doc]
+            if course_id in removed:
+                continue
+            score = TRIGRAM_SCORE * counts[doc] / len(query_grams)
+            if code_key == query:
+                score += EXACT_CODE_SCORE
+            elif code_key.startswith(query):
+                score += CODE_PREFIX_SCORE
+            elif query in code_key:
+                score += CODE_MATCH_SCORE
+            if (" " + name_key).find(" " + words) >= 0:
+                score += NAME_WORD_SCORE
+            elif query in name_compact:
+                score += NAME_MATCH_SCORE
+            ranked.append((-score, code, course_id, name))
+        return [(course_id, code, name) for _, code, course_id, name in heapq.nsmallest(limit, ranked)]
+
+
+class CourseTypeahead:
+    """
+    Prefix index over course codes and short titles for autocomplete,
+    results are ordered by how many users are enrolled in the course
+    """
+    def __init__(self):
+        """
+        Initializes an empty typeahead, call build() to load it from the database
+        """
+        self.lock = threading.Lock()
+        self.data = ([], [], [], {})
+        self.removed = set()
+
+    def build(self):
+        """
+        Rebuilds the prefix index from the courses table and swaps it in, must run inside an app context
+        """
+        popularity = dict(db.session.query(
+            Session.course_id, db.func.count(db.distinct(user_session_table.c.user_id))
+        ).join(Session, Session.id == user_session_table.c.session_id).group_by(Session.course_id))
+        courses = db.session.query(Course.id, Course.code, Course.name).all()
+        # A course's rank is its position by enrollment, so sorting ranks sorts by popularity
+        courses.sort(key=lambda c: (-popularity.get(c[0], 0), c[1]))
+        entries = []
+        for rank, (course_id, code, name) in enumerate(courses):
+            words = normalize(name).split()
+            keys = {compact(code)} | {" ".join(words[i:]) for i in range(len(words))}
+            entries.extend((key, rank) for key in keys if key)
+        entries.sort()
+        top = {}
+        for key, rank in entries:
+            for length in range(1, min(len(key), TYPEAHEAD_DEPTH) + 1):
+                top.setdefault(key[:length], set()).add(rank)
+        top = {prefix: sorted(ranks)[:MAX_TYPEAHEAD_LIMIT] for prefix, ranks in top.items()}
+        data = (courses, [key for key, _ in entries], [rank for _, rank in entries], top)
+        with self.lock:
+            self.data = data
+            self.removed = set()
+
+    def discard(self, course_id):
+        """
+        Hides a deleted course until the next rebuild
+        """
+        with self.lock:
+            self.removed.add(course_id)
+
+    def complete(self, prefix, limit=TYPEAHEAD_LIMIT):
+        """
+        Returns (course id, code, name) tuples whose code or title starts with prefix, most enrolled first
+        """
+        with self.lock:
+            courses, keys, ranks, top = self.data
+            removed = set(self.removed)
+        found = set()
+        for query in {normalize(prefix), compact(prefix)}:
+            if not query:
+                continue
+            if len(query) <= TYPEAHEAD_DEPTH:
+                found.update(top.get(query, ()))
+            else:
+                low = bisect_left(keys, query)
+                high = bisect_left(keys, query + "\uffff")
+                found.update(ranks[low:high])
+        results = []
+        for rank in sorted(found):
+            course = courses[rank]
+            if course[0] not in removed:
+                results.append(course)
+                if len(results) == limit:
+                    break
+        return results
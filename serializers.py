@@ -0,0 +1,29 @@
+from sqlalchemy.orm import selectinload
+from db import User, Course, Session
+
+# Relationships read by each serialize() output shape. Passing a shape to
+# query.options() loads every related row of all parent rows up front with
+# one SELECT ... IN per relationship, instead of one lazy load per row.
+USER_SHAPE = (
+    selectinload(User.major),
+    selectinload(User.interests),
+    selectinload(User.sessions),
+    selectinload(User.friendships),
+)
+COURSE_SHAPE = (
+    selectinload(Course.sessions),
+)
+SESSION_SHAPE = (
+    selectinload(Session.course),
+    selectinload(Session.students),
+)
+SCHEDULE_SHAPE = (
+    selectinload(User.sessions).selectinload(Session.course),
+    selectinload(User.sessions).selectinload(Session.students),
+)
+
+def shaped(query, shape):
+    """
+    Return query with the relationships of an output shape batch loaded
+    """
+    return query.options(*shape)
@@ -1,9 +1,13 @@
+import time
 import uuid
 import json
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_sock import Sock
+from fanout import make_hub
+from group_commit import GroupCommitWriter
+from metrics import MetricsRegistry, init_app as init_metrics
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///messages.db'
@@ -11,13 +15,30 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 sock = Sock(app)
 
+BACKFILL_BATCH = 1000
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+WS_ACTIONS = ("send_message", "delete_message")
+
+# Latency histograms of the HTTP routes and WebSocket actions, served at /metrics
+ws_metrics = MetricsRegistry()
+init_metrics(app, ws_metrics)
+
+def conversation_key(user_1, user_2):
+    # Same key for [a, b] and [b, a], and for ids sent as numbers or strings
+    return ":".join(sorted([str(user_1), str(user_2)]))
+
 class Message(db.Model):
     __tablename__ = 'messages'
     message_id = db.Column(db.String, primary_key=True, default=lambda: str(uuid.uuid4()))
     participants = db.Column(db.JSON, nullable=False)
+    conversation_key = db.Column(db.String)
     sent_by = db.Column(db.String, nullable=False)
     message = db.Column(db.String, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_messages_conversation_key_timestamp', 'conversation_key', 'timestamp'),
+    )
 
     def serialize(self):
         return {
@@ -28,8 +49,28 @@ class Message(db.Model):
             'timestamp': self.timestamp.isoformat()
         }
 
+def backfill_conversation_keys():
+    # Databases created before conversation_key existed get the column, its
+    # index and a key for every old row
+    columns = [c['name'] for c in db.inspect(db.engine).get_columns('messages')]
+    if 'conversation_key' not in columns:
+        db.session.execute(db.text('ALTER TABLE messages ADD COLUMN conversation_key VARCHAR'))
+    db.session.execute(db.text(
+        'CREATE INDEX IF NOT EXISTS ix_messages_conversation_key_timestamp '
+        'ON messages (conversation_key, timestamp)'
+    ))
+    db.session.commit()
+    while True:
+        msgs = Message.query.filter(Message.conversation_key.is_(None)).limit(BACKFILL_BATCH).all()
+        if not msgs:
+            break
+        for m in msgs:
+            m.conversation_key = conversation_key(*m.participants)
+        db.session.commit()
+
 with app.app_context():
     db.create_all()
+    backfill_conversation_keys()
 
 @app.route("/messages/", methods=["POST"])
 def create_message():
@@ -48,6 +89,7 @@ def create_message():
 
     msg = Message(
         participants=parts,
+        conversation_key=conversation_key(*parts),
         sent_by=data['sent_by'],
         message=data['message']
     )
@@ -84,12 +126,8 @@ def get_history():
     after = request.args.get("after_timestamp")
     during = request.args.get("during_timestamp")
 
-    # Normalize participant order so [a, b] and [b, a] are treated the same.
-    canonical = sorted([u1, u2])
-
-    q = Message.query.filter(
-        (Message.participants == canonical) | (Message.participants == [u2, u1])
-    )
+    # The key is the same for [a, b] and [b, a], so one index range covers the conversation.
+    q = Message.query.filter(Message.conversation_key == conversation_key(u1, u2))
 
     if before:
         q = q.filter(Message.timestamp < datetime.fromisoformat(before))
@@ -99,10 +137,56 @@ def get_history():
         dt = datetime.fromisoformat(during)
         q = q.filter(Message.timestamp == dt)
 
-    msgs = q.order_by(Message.timestamp.asc()).all()
-    return jsonify([m.serialize() for m in msgs]), 200
-
-active_connections = {}
+    limit = request.args.get("limit", type=int)
+    before_id = request.args.get("before_id")
+    after_id = request.args.get("after_id")
+
+    if limit is None and before_id is None and after_id is None:
+        msgs = q.order_by(Message.timestamp.asc()).all()
+        return jsonify([m.serialize() for m in msgs]), 200
+
+    # Keyset pagination on (timestamp, message_id), pages are newest first.
+    # before_id pages towards older messages, after_id towards newer ones,
+    # next_cursor is the id to pass as the same parameter for the next page.
+    limit = min(max(limit or HISTORY_PAGE_SIZE, 1), MAX_HISTORY_PAGE_SIZE)
+    cursor_id = after_id or before_id
+    if cursor_id:
+        cursor = Message.query.filter_by(
+            message_id=cursor_id, conversation_key=conversation_key(u1, u2)
+        ).first()
+        if not cursor:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    if after_id:
+        q = q.filter(
+            Message.timestamp >= cursor.timestamp,
+            ~((Message.timestamp == cursor.timestamp) & (Message.message_id <= cursor.message_id))
+        )
+        msgs = q.order_by(Message.timestamp.asc(), Message.message_id.asc()).limit(limit + 1).all()
+        more = len(msgs) > limit
+        msgs = msgs[:limit][::-1]
+        next_cursor = msgs[0].message_id if more else None
+    else:
+        if before_id:
+            q = q.filter(
+                Message.timestamp <= cursor.timestamp,
+                ~((Message.timestamp == cursor.timestamp) & (Message.message_id >= cursor.message_id))
+            )
+        msgs = q.order_by(Message.timestamp.desc(), Message.message_id.desc()).limit(limit + 1).all()
+        more = len(msgs) > limit
+        msgs = msgs[:limit]
+        next_cursor = msgs[-1].message_id if more else None
+
+    return jsonify({"messages": [m.serialize() for m in msgs], "next_cursor": next_cursor}), 200
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return ws_metrics.response()
+
+# Routes events to the recipient's socket on whichever worker holds it
+hub = make_hub()
+# Inserts messages sent over WebSockets with one commit per batch
+writer = GroupCommitWriter(app, db)
 
 @sock.route('/ws')
 def websocket_handler(ws):
@@ -119,51 +203,64 @@ def websocket_handler(ws):
 
             if user_id is None:
                 user_id = data["user_id"]
-                active_connections[user_id] = ws
+                hub.register(user_id, ws)
 
             action = data.get("action")
-
-            if action == "send_message":
-                target = data.get("target_user_id")
-                text = data.get("message")
-
-                participants = sorted([user_id, target])
-
-                msg = Message(
-                    participants=participants,
-                    sent_by=user_id,
-                    message=text
-                )
-                db.session.add(msg)
-                db.session.commit()
-
-                payload = {"type": "new_message", **msg.serialize()}
-
-                if target in active_connections:
-                    active_connections[target].send(json.dumps(payload))
-
-                ws.send(json.dumps(payload))
-
-            if action == "delete_message":
-                message_id = data.get("message_id")
-                msg = Message.query.filter_by(message_id=message_id).first()
-
-                if msg and msg.sent_by == user_id:
-                    db.session.delete(msg)
-                    db.session.commit()
-
-                    notice = {
-                        "type": "message_deleted",
-                        "message_id": message_id
-                    }
-
-                    for uid in msg.participants:
-                        if uid in active_connections:
-                            active_connections[uid].send(json.dumps(notice))
+            label = action if action in WS_ACTIONS else "other"
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                if action == "send_message":
+                    target = data.get("target_user_id")
+                    text = data.get("message")
+                    if target is None or text is None:
+                        ws.send(json.dumps({"type": "error", "error": "Missing fields"}))
+                        outcome = "rejected"
+                        continue
+
+                    participants = sorted([user_id, target])
+
+                    msg = Message(
+                        participants=participants,
+                        conversation_key=conversation_key(user_id, target),
+                        sent_by=user_id,
+                        message=text
+                    )
+                    # Wait for the batch holding msg to commit, so nothing is
+                    # delivered that a crash could still lose
+                    try:
+                        payload = {"type": "new_message", **writer.submit(msg).result()}
+                    except Exception:
+                        ws.send(json.dumps({"type": "error", "error": "Message not saved"}))
+                        continue
+
+                    hub.publish([target], json.dumps(payload))
+
+                    ws.send(json.dumps(payload))
+
+                if action == "delete_message":
+                    message_id = data.get("message_id")
+                    msg = Message.query.filter_by(message_id=message_id).first()
+
+                    if msg and msg.sent_by == user_id:
+                        db.session.delete(msg)
+                        db.session.commit()
+
+                        notice = {
+                            "type": "message_deleted",
+                            "message_id": message_id
+                        }
+
+                        hub.publish(msg.participants, json.dumps(notice))
+                outcome = "ok"
+            finally:
+                ws_metrics.observe("websocket_action_duration_seconds", (("action", label),), time.perf_counter() - started)
+                ws_metrics.inc("websocket_actions_total", (("action", label), ("outcome", outcome)))
+                ws_metrics.inc("websocket_message_bytes_total", (("action", label),), len(raw.encode() if isinstance(raw, str) else raw))
 
     finally:
-        if user_id in active_connections:
-            del active_connections[user_id]
+        if user_id is not None:
+            hub.unregister(user_id, ws)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,141 @@
+import re
+import time
+import threading
+from collections import Counter
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+
+# A request running the same statement shape more than this many times is flagged as N+1
+N_PLUS_ONE_THRESHOLD = 10
+SLOW_STATEMENT_LENGTH = 500
+DEBUG_HEADER = "X-SQL-Stats"
+
+WHITESPACE = re.compile(r"\s+")
+# Expanded IN lists differ in length per call but are the same shape
+IN_LIST = re.compile(r"IN \((?:\?, )*\?\)")
+
+def statement_shape(statement):
+    """
+    Returns statement with whitespace and IN list lengths normalized
+    """
+    return IN_LIST.sub("IN (?)", WHITESPACE.sub(" ", statement).strip())
+
+class SQLStats:
+    """
+    Opt-in per-request SQL instrumentation: query count, total SQL time and
+    the slowest statement of each request, aggregated by Flask endpoint, and
+    detection of requests repeating one statement shape (N+1)
+    """
+    def __init__(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """
+        Initializes empty aggregates, call init_app() to start recording
+        """
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def init_app(self, app, engine):
+        """
+        Hooks into the engine's cursor events and the app's request cycle.
+        In debug mode every response carries its request's numbers in X-SQL-Stats
+        """
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """
+        Remembers when a statement started on its execution context, which is
+        dropped with the statement even when it raises
+        """
+        if context is not None:
+            context.sql_stats_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """
+        Adds a finished statement to the current request's numbers
+        """
+        start = getattr(context, "sql_stats_start", None)
+        if start is None or not has_request_context() or "sql_stats" not in g:
+            return
+        elapsed = time.perf_counter() - start
+        stats = g.sql_stats
+        stats["queries"] += 1
+        stats["seconds"] += elapsed
+        if elapsed > stats["slowest_seconds"]:
+            stats["slowest_seconds"] = elapsed
+            stats["slowest"] = statement
+        stats["shapes"][statement_shape(statement)] += 1
+
+    def before_request(self):
+        """
+        Starts the numbers of a request
+        """
+        g.sql_stats = {"queries": 0, "seconds": 0.0, "slowest_seconds": 0.0, "slowest": None, "shapes": Counter()}
+
+    def after_request(self, response):
+        """
+        Folds a request's numbers into its endpoint's aggregates
+        """
+        stats = g.pop("sql_stats", None)
+        if stats is None:
+            return response
+        endpoint = request.endpoint or "<unmatched>"
+        repeated = [(shape, n) for shape, n in stats["shapes"].items() if n > self.threshold]
+        with self.lock:
+            totals = self.endpoints.setdefault(endpoint, {
+                "requests": 0, "queries": 0, "seconds": 0.0, "max_queries": 0,
+                "slowest_seconds": 0.0, "slowest": None, "n_plus_one": 0, "n_plus_one_shapes": {}
+            })
+            totals["requests"] += 1
+            totals["queries"] += stats["queries"]
+            totals["seconds"] += stats["seconds"]
+            totals["max_queries"] = max(totals["max_queries"], stats["queries"])
+            if stats["slowest_seconds"] > totals["slowest_seconds"]:
+                totals["slowest_seconds"] = stats["slowest_seconds"]
+                totals["slowest"] = stats["slowest"]
+            if repeated:
+                totals["n_plus_one"] += 1
+                for shape, n in repeated:
+                    totals["n_plus_one_shapes"][shape] = max(totals["n_plus_one_shapes"].get(shape, 0), n)
+        if repeated:
+            print("N+1 in %s: %d queries, %s" % (endpoint, stats["queries"], "; ".join(
+                "%dx %s" % (n, shape[:SLOW_STATEMENT_LENGTH]) for shape, n in repeated)))
+        if current_app.debug:
+            response.headers[DEBUG_HEADER] = "queries=%d; time_ms=%.2f; slowest_ms=%.2f; n_plus_one=%d" % (
+                stats["queries"], stats["seconds"] * 1000, stats["slowest_seconds"] * 1000, len(repeated))
+        return response
+
+    def report(self):
+        """
+        Returns the aggregates of every endpoint, most total SQL time first
+        """
+        with self.lock:
+            rows = []
+            for endpoint, totals in self.endpoints.items():
+                rows.append({
+                    "endpoint": endpoint,
+                    "requests": totals["requests"],
+                    "queries": totals["queries"],
+                    "queries_per_request": round(totals["queries"] / totals["requests"], 2),
+                    "max_queries": totals["max_queries"],
+                    "sql_ms": round(totals["seconds"] * 1000, 3),
+                    "sql_ms_per_request": round(totals["seconds"] * 1000 / totals["requests"], 3),
+                    "slowest_ms": round(totals["slowest_seconds"] * 1000, 3),
+                    "slowest": (totals["slowest"] or "")[:SLOW_STATEMENT_LENGTH],
+                    "n_plus_one_requests": totals["n_plus_one"],
+                    "n_plus_one_shapes": [
+                        {"count": n, "statement": shape[:SLOW_STATEMENT_LENGTH]}
+                        for shape, n in totals["n_plus_one_shapes"].items()
+                    ]
+                })
+        rows.sort(key=lambda row: row["sql_ms"], reverse=True)
+        return {"threshold": self.threshold, "endpoints": rows}
+
+    def reset(self):
+        """
+        Clears every aggregate
+        """
+        with self.lock:
+            self.endpoints = {}
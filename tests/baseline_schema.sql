@@ -0,0 +1,81 @@
+-- Schema created by db.py before any migration, the starting point of every existing database
+CREATE TABLE courses (
+	id INTEGER NOT NULL, 
+	code VARCHAR NOT NULL, 
+	name VARCHAR NOT NULL, 
+	PRIMARY KEY (id), 
+	UNIQUE (code)
+);
+CREATE TABLE majors (
+	id INTEGER NOT NULL, 
+	major VARCHAR NOT NULL, 
+	PRIMARY KEY (id), 
+	UNIQUE (major)
+);
+CREATE TABLE interest_categories (
+	id INTEGER NOT NULL, 
+	name VARCHAR NOT NULL, 
+	PRIMARY KEY (id), 
+	UNIQUE (name)
+);
+CREATE TABLE users (
+	id INTEGER NOT NULL, 
+	google_id VARCHAR NOT NULL, 
+	name VARCHAR NOT NULL, 
+	email VARCHAR NOT NULL, 
+	profile_picture VARCHAR, 
+	major_id INTEGER, 
+	PRIMARY KEY (id), 
+	UNIQUE (google_id), 
+	UNIQUE (email), 
+	FOREIGN KEY(major_id) REFERENCES majors (id)
+);
+CREATE TABLE sessions (
+	id INTEGER NOT NULL, 
+	course_id INTEGER NOT NULL, 
+	class_number VARCHAR NOT NULL, 
+	name VARCHAR NOT NULL, 
+	time VARCHAR, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(course_id) REFERENCES courses (id), 
+	UNIQUE (class_number)
+);
+CREATE TABLE interests (
+	id INTEGER NOT NULL, 
+	name VARCHAR NOT NULL, 
+	category_id INTEGER NOT NULL, 
+	PRIMARY KEY (id), 
+	UNIQUE (name), 
+	FOREIGN KEY(category_id) REFERENCES interest_categories (id)
+);
+CREATE TABLE user_session_association (
+	session_id INTEGER, 
+	user_id INTEGER, 
+	FOREIGN KEY(session_id) REFERENCES sessions (id), 
+	FOREIGN KEY(user_id) REFERENCES users (id)
+);
+CREATE TABLE user_interest_association (
+	user_id INTEGER, 
+	interest_id INTEGER, 
+	FOREIGN KEY(user_id) REFERENCES users (id), 
+	FOREIGN KEY(interest_id) REFERENCES interests (id)
+);
+CREATE TABLE friends (
+	id INTEGER NOT NULL, 
+	user_id INTEGER NOT NULL, 
+	friend_id INTEGER NOT NULL, 
+	status VARCHAR NOT NULL, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(user_id) REFERENCES users (id), 
+	FOREIGN KEY(friend_id) REFERENCES users (id)
+);
+CREATE TABLE messages (
+	id INTEGER NOT NULL, 
+	sender_id INTEGER NOT NULL, 
+	receiver_id INTEGER NOT NULL, 
+	content VARCHAR NOT NULL, 
+	sent_at DATETIME, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(sender_id) REFERENCES users (id) ON DELETE CASCADE, 
+	FOREIGN KEY(receiver_id) REFERENCES users (id) ON DELETE CASCADE
+);
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# app.py builds its database on import, so point it at a scratch file first
+SCRATCH = tempfile.mkdtemp(prefix="cms-tests-")
+os.environ["CMS_DB"] = os.path.join(SCRATCH, "cms.db")
+os.environ["CATALOG_SNAPSHOT"] = os.path.join(SCRATCH, "catalog.snapshot")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,32 @@
+import os
+import sys
+import json
+import sqlite3
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LIST_COURSES = """
+import json
+from app import app
+print(json.dumps(json.loads(app.test_client().get("/courses/").data)))
+"""
+
+def list_courses(env):
+    """
+    Starts the app in a new process and returns its /courses/ response
+    """
+    result = subprocess.run([sys.executable, "-c", LIST_COURSES], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_startup_rewrites_stale_snapshot(tmp_path):
+    env = dict(os.environ, CMS_DB=str(tmp_path / "cms.db"), CATALOG_SNAPSHOT=str(tmp_path / "catalog.snapshot"))
+    assert list_courses(env) == {"courses": []}
+    # Courses added while the app was down, e.g. by another tool
+    connection = sqlite3.connect(tmp_path / "cms.db")
+    connection.execute("INSERT INTO courses (code, name) VALUES ('CS1110', 'Intro Computing Using Python')")
+    connection.commit()
+    connection.close()
+    assert list_courses(env)["courses"] == [{"id": 1, "code": "CS1110", "name": "Intro Computing Using Python"}]
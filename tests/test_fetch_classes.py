@@ -0,0 +1,164 @@
+import os
+import time
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+from flask import Flask
+
+import fetch_classes
+from fetch_classes import fetch_all, TokenBucket, API_RETRIES
+from db import db, Course, Session
+
+# Responses of the classes API recorded into tests/roster, with the
+# classes of each subject in classes_<subject>.json
+RECORDED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "roster")
+RATE_LIMIT = 0.02
+
+class RosterStub(BaseHTTPRequestHandler):
+    """
+    Replays the recorded roster. A subject in failures gets that many 500s
+    before its recorded response
+    """
+    protocol_version = "HTTP/1.1"
+    failures = {}
+    hits = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        subject = parse_qs(url.query).get("subject", [None])[0]
+        RosterStub.hits.append((time.monotonic(), subject))
+        if url.path.endswith("/config/subjects.json"):
+            name = "subjects.json"
+        else:
+            name = "classes_%s.json" % subject
+        if RosterStub.failures.get(subject, 0) > 0:
+            RosterStub.failures[subject] -= 1
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with open(os.path.join(RECORDED, name), "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub():
+    """
+    Serves the recorded roster on a local port, returns its base URL
+    """
+    RosterStub.failures = {}
+    RosterStub.hits = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RosterStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def roster_app(tmp_path, monkeypatch):
+    """
+    App with an empty scratch database, and a fast rate limit and backoff
+    """
+    monkeypatch.setattr(fetch_classes, "API_RATE_LIMIT", RATE_LIMIT)
+    monkeypatch.setattr(fetch_classes, "API_BACKOFF", 0.01)
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % (tmp_path / "roster.db")
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def recorded_rows():
+    """
+    Returns the course codes and session class numbers of the recorded roster
+    """
+    courses, sessions = set(), set()
+    for name in os.listdir(RECORDED):
+        if not name.startswith("classes_"):
+            continue
+        with open(os.path.join(RECORDED, name)) as f:
+            for item in json.load(f)["data"]["classes"]:
+                courses.add(item["subject"] + item["catalogNbr"])
+                for group in item["enrollGroups"]:
+                    sessions.update(str(s["classNbr"]) for s in group["classSections"])
+    return courses, sessions
+
+
+def stored_rows(app):
+    """
+    Returns the course codes and session class numbers in the database
+    """
+    with app.app_context():
+        return {c.code for c in Course.query}, {s.class_number for s in Session.query}
+
+
+def test_fetch_all_inserts_recorded_roster(stub, roster_app, tmp_path):
+    courses, sessions = recorded_rows()
+    counts = fetch_all(roster_app, base_url=stub, cache_dir=str(tmp_path / "cache"))
+    assert counts["subjects"] == {"synced": 3, "skipped": 0, "failed": 0}
+    assert counts["courses"] == {"inserted": len(courses), "updated": 0, "unchanged": 0}
+    assert counts["sessions"] == {"inserted": len(sessions), "updated": 0, "unchanged": 0}
+    assert stored_rows(roster_app) == (courses, sessions)
+    with roster_app.app_context():
+        session = Session.query.filter_by(class_number="10002").one()
+        assert (session.name, session.time, session.course.code) == ("DIS201", "M 12:20PM", "CS1110")
+
+
+def test_fetch_all_retries_server_errors(stub, roster_app, tmp_path):
+    RosterStub.failures = {"MATH": 2, "PHYS": API_RETRIES + 1}
+    counts = fetch_all(roster_app, base_url=stub, cache_dir=str(tmp_path / "cache"))
+    assert counts["subjects"] == {"synced": 2, "skipped": 0, "failed": 1}
+    hits = [subject for _, subject in RosterStub.hits]
+    assert hits.count("MATH") == 3
+    assert hits.count("PHYS") == API_RETRIES + 1
+    courses, sessions = stored_rows(roster_app)
+    assert "MATH1920" in courses and "20002" in sessions
+    assert not any(code.startswith("PHYS") for code in courses)
+
+
+def test_fetch_all_skips_synced_subjects(stub, roster_app, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    fetch_all(roster_app, base_url=stub, cache_dir=cache_dir)
+    counts = fetch_all(roster_app, base_url=stub, cache_dir=cache_dir)
+    assert counts["subjects"] == {"synced": 0, "skipped": 3, "failed": 0}
+    assert counts["courses"]["inserted"] == 0
+
+
+def test_fetch_all_respects_rate_limit(stub, roster_app, tmp_path):
+    RosterStub.failures = {"CS": 1}
+    fetch_all(roster_app, base_url=stub, cache_dir=str(tmp_path / "cache"))
+    times = sorted(t for t, _ in RosterStub.hits)
+    # A full bucket of API_BURST tokens, then one request per RATE_LIMIT across all workers
+    requests = len(times) - fetch_classes.API_BURST
+    assert times[-1] - times[0] >= requests * RATE_LIMIT * 0.9
+
+
+def test_token_bucket_spaces_threads():
+    bucket = TokenBucket(interval=0.01, capacity=2)
+    taken = []
+    def worker():
+        for _ in range(5):
+            bucket.acquire()
+            taken.append(time.monotonic())
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 20 tokens, 2 of them in the initial burst
+    assert len(taken) == 20
+    assert max(taken) - start >= 18 * 0.01 * 0.9
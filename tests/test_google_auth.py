@@ -0,0 +1,189 @@
+import json
+import time
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.auth import crypt, jwt
+
+import google_auth
+from google_auth import GoogleTokenVerifier, DEFAULT_CERTS_MAX_AGE
+
+CLIENT_ID = "test-client.apps.googleusercontent.com"
+
+def make_key(kid):
+    """
+    Returns a signer with a fresh RSA key and the PEM certificate publishing it
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, kid)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()
+    ).serial_number(x509.random_serial_number()).not_valid_before(
+        now - datetime.timedelta(days=1)
+    ).not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256())
+    private = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    return crypt.RSASigner.from_string(private, key_id=kid), cert.public_bytes(serialization.Encoding.PEM).decode()
+
+KEYS = {kid: make_key(kid) for kid in ["key-1", "key-2", "key-3"]}
+
+def make_token(kid="key-1", **claims):
+    """
+    Returns an ID token signed with the key kid, claims override the defaults
+    """
+    now = int(time.time())
+    payload = {
+        "iss": "https://accounts.google.com",
+        "aud": CLIENT_ID,
+        "sub": "1234567890",
+        "email": "student@cornell.edu",
+        "name": "Student",
+        "iat": now,
+        "exp": now + 3600,
+    }
+    payload.update(claims)
+    return jwt.encode(KEYS[kid][0], payload).decode()
+
+
+class CertsStub(BaseHTTPRequestHandler):
+    """
+    Serves the certs of the keys in published with the given Cache-Control header
+    """
+    published = ["key-1"]
+    cache_control = "public, max-age=%d" % DEFAULT_CERTS_MAX_AGE
+    fetches = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        CertsStub.fetches += 1
+        body = json.dumps({kid: KEYS[kid][1] for kid in CertsStub.published}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Cache-Control", CertsStub.cache_control)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Clock:
+    """
+    Replaces the time module of google_auth, so cert expiry can be tested without sleeping
+    """
+    def __init__(self):
+        self.offset = 0
+
+    def time(self):
+        return time.time() + self.offset
+
+
+@pytest.fixture
+def certs_url():
+    CertsStub.published = ["key-1"]
+    CertsStub.cache_control = "public, max-age=%d" % DEFAULT_CERTS_MAX_AGE
+    CertsStub.fetches = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CertsStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d/oauth2/v1/certs" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(google_auth, "time", clock)
+    return clock
+
+
+def test_verify_returns_claims(certs_url):
+    verifier = GoogleTokenVerifier(certs_url)
+    idinfo = verifier.verify(make_token())
+    assert (idinfo["sub"], idinfo["aud"], idinfo["email"]) == ("1234567890", CLIENT_ID, "student@cornell.edu")
+
+
+def test_certs_are_cached_for_max_age(certs_url, clock):
+    CertsStub.cache_control = "public, max-age=120"
+    verifier = GoogleTokenVerifier(certs_url)
+    verifier.verify(make_token(sub="a"))
+    clock.offset = 119
+    verifier.verify(make_token(sub="b"))
+    assert CertsStub.fetches == 1
+    clock.offset = 121
+    verifier.verify(make_token(sub="c"))
+    assert CertsStub.fetches == 2
+
+
+def test_certs_max_age_counts_age_and_no_cache():
+    assert GoogleTokenVerifier.max_age({"Cache-Control": "public, max-age=120", "Age": "100"}) == 20
+    assert GoogleTokenVerifier.max_age({"Cache-Control": "no-cache, max-age=120"}) == 0
+    assert GoogleTokenVerifier.max_age({}) == DEFAULT_CERTS_MAX_AGE
+
+
+def test_verified_token_is_not_verified_again(certs_url, monkeypatch):
+    verifier = GoogleTokenVerifier(certs_url)
+    token = make_token()
+    decodes = []
+    decode = jwt.decode
+    def counting_decode(*args, **kwargs):
+        decodes.append(args[0])
+        return decode(*args, **kwargs)
+    monkeypatch.setattr(google_auth.jwt, "decode", counting_decode)
+    first = verifier.verify(token)
+    second = verifier.verify(token)
+    assert first == second
+    assert len(decodes) == 1
+    assert verifier.stats()["hits"] == 1
+    assert CertsStub.fetches == 1
+
+
+def test_unknown_key_refreshes_certs_once(certs_url):
+    verifier = GoogleTokenVerifier(certs_url)
+    verifier.verify(make_token())
+    # Google rotated its keys after the verifier cached the certs
+    CertsStub.published = ["key-1", "key-2"]
+    assert verifier.verify(make_token("key-2"))["sub"] == "1234567890"
+    assert CertsStub.fetches == 2
+    # A key that is still unknown does not refetch within CERTS_MIN_REFRESH
+    with pytest.raises(ValueError):
+        verifier.verify(make_token("key-3"))
+    assert CertsStub.fetches == 2
+
+
+def test_wrong_issuer_is_rejected(certs_url):
+    verifier = GoogleTokenVerifier(certs_url)
+    token = make_token(iss="https://accounts.example.com")
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            verifier.verify(token)
+    assert verifier.stats()["size"] == 0
+
+
+def test_expired_token_is_rejected(certs_url):
+    verifier = GoogleTokenVerifier(certs_url)
+    now = int(time.time())
+    with pytest.raises(ValueError):
+        verifier.verify(make_token(iat=now - 7200, exp=now - 3600))
+    assert verifier.stats()["size"] == 0
+
+
+def test_wrong_audience_is_rejected_by_login(certs_url, monkeypatch):
+    import app as service
+    monkeypatch.setattr(service, "token_verifier", GoogleTokenVerifier(certs_url))
+    monkeypatch.setattr(service, "GOOGLE_CLIENT_ID", CLIENT_ID)
+    client = service.app.test_client()
+    response = client.post("/auth/google", data=json.dumps({"token_id": make_token(aud="someone-else")}))
+    assert response.status_code == 400
+    assert json.loads(response.data) == {"error": "Invalid audience"}
+    response = client.post("/auth/google", data=json.dumps({"token_id": make_token()}))
+    assert response.status_code == 201
+    assert json.loads(response.data)["email"] == "student@cornell.edu"
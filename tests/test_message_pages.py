@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import app as service
+from db import db, User
+
+MESSAGES = 7
+
+@pytest.fixture(scope="module")
+def conversation():
+    """
+    Sends MESSAGES messages back and forth between two users through the
+    route, interleaved with messages to a third user. Returns the two user
+    ids and the conversation's message ids, oldest first
+    """
+    with service.app.app_context():
+        users = [User(google_id="pages-%d" % i, name="p%d" % i, email="pages%d@example.com" % i) for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        a, b, other = [u.id for u in users]
+    client = service.app.test_client()
+    ids = []
+    for i in range(MESSAGES):
+        sender, receiver = (a, b) if i % 2 == 0 else (b, a)
+        response = client.post("/messages/send/", data=json.dumps(
+            {"sender_id": sender, "receiver_id": receiver, "content": "m%d" % i}
+        ))
+        assert response.status_code == 201
+        ids.append(json.loads(response.data)["id"])
+        client.post("/messages/send/", data=json.dumps({"sender_id": a, "receiver_id": other, "content": "x%d" % i}))
+    return a, b, ids
+
+
+def page(a, b, **params):
+    response = service.app.test_client().get("/messages/%d/%d/" % (a, b), query_string=params)
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, MESSAGES, MESSAGES + 1])
+def test_pages_towards_older_messages(conversation, limit):
+    a, b, ids = conversation
+    seen = []
+    body = page(a, b, limit=limit)
+    while True:
+        seen.extend(m["id"] for m in body["messages"])
+        if body["next_cursor"] is None:
+            break
+        assert len(seen) <= MESSAGES
+        body = page(a, b, limit=limit, before_id=body["next_cursor"])
+    assert seen == ids[::-1]
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, MESSAGES, MESSAGES + 1])
+def test_pages_towards_newer_messages(conversation, limit):
+    a, b, ids = conversation
+    seen = [ids[0]]
+    body = page(b, a, limit=limit, after_id=ids[0])
+    while True:
+        # Each page is newest first
+        seen.extend(reversed([m["id"] for m in body["messages"]]))
+        if body["next_cursor"] is None:
+            break
+        assert len(seen) <= MESSAGES
+        body = page(b, a, limit=limit, after_id=body["next_cursor"])
+    assert seen == ids
+
+
+def test_page_contents_and_cursor_checks(conversation):
+    a, b, ids = conversation
+    body = page(a, b, limit=2)
+    assert [m["content"] for m in body["messages"]] == ["m%d" % (MESSAGES - 1), "m%d" % (MESSAGES - 2)]
+    assert body["next_cursor"] == ids[-2]
+    assert page(a, b, before_id=ids[0]) == {"messages": [], "next_cursor": None}
+    # A message of another conversation is not a valid cursor
+    other = service.app.test_client().get("/messages/%d/%d/" % (a, b), query_string={"before_id": ids[-1] + 1})
+    assert other.status_code == 400
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+
+import pytest
+from flask import Flask
+from sqlalchemy.exc import IntegrityError
+
+import app as service
+from db import db
+from migrations import migrate, check_query_plans, plan_checks, MIGRATIONS
+
+BASELINE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_schema.sql")
+
+BASELINE_ROWS = [
+    "INSERT INTO users (id, google_id, name, email) VALUES (1, 'g1', 'a', 'a@x'), (2, 'g2', 'b', 'b@x'), (3, 'g3', 'c', 'c@x')",
+    "INSERT INTO interest_categories (id, name) VALUES (1, 'Games')",
+    "INSERT INTO interests (id, name, category_id) VALUES (1, 'Chess', 1)",
+    "INSERT INTO courses (id, code, name) VALUES (1, 'CS1110', 'Intro')",
+    "INSERT INTO sessions (id, course_id, class_number, name) VALUES (1, 1, '10001', 'LEC001')",
+    # A duplicate, a NULL and rows of a deleted user and a deleted session
+    "INSERT INTO user_session_association (session_id, user_id) VALUES (1, 1), (1, 1), (1, 2), (NULL, 2), (1, 99), (77, 1)",
+    # Duplicates and rows of a deleted user and a deleted interest
+    "INSERT INTO user_interest_association (user_id, interest_id) VALUES (1, 1), (1, 1), (99, 1), (1, 55)",
+    # The same pair requested from both sides, one accepted
+    "INSERT INTO friends (id, user_id, friend_id, status) VALUES (1, 1, 2, 'Pending'), (2, 2, 1, 'Accepted'), (3, 1, 3, 'Pending')",
+    "INSERT INTO messages (id, sender_id, receiver_id, content, sent_at) VALUES (1, 1, 2, 'hi', '2026-01-01 10:00:00')",
+]
+
+@pytest.fixture
+def baseline_app(tmp_path):
+    """
+    App on a database created by the code before any migration, with the
+    duplicate and orphan rows it allowed
+    """
+    path = tmp_path / "baseline.db"
+    connection = sqlite3.connect(path)
+    with open(BASELINE_SCHEMA) as f:
+        connection.executescript(f.read())
+    for statement in BASELINE_ROWS:
+        connection.execute(statement)
+    connection.commit()
+    connection.close()
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % path
+    db.init_app(app)
+    return app
+
+
+def rows(statement):
+    return db.session.execute(db.text(statement)).all()
+
+
+def test_migrate_upgrades_baseline_database(baseline_app):
+    with baseline_app.app_context():
+        migrate()
+        assert [v for (v,) in rows("SELECT version FROM schema_migrations ORDER BY version")] == [v for v, _, _ in MIGRATIONS]
+        assert set(rows("SELECT session_id, user_id FROM user_session_association")) == {(1, 1), (1, 2)}
+        assert set(rows("SELECT user_id, interest_id FROM user_interest_association")) == {(1, 1)}
+        assert set(rows("SELECT pair_low, pair_high, status FROM friends")) == {(1, 2, "Accepted"), (1, 3, "Pending")}
+        assert rows("SELECT content FROM messages") == [("hi",)]
+        with pytest.raises(IntegrityError):
+            db.session.execute(db.text("INSERT INTO user_session_association (session_id, user_id) VALUES (1, 1)"))
+        db.session.rollback()
+        with pytest.raises(IntegrityError):
+            db.session.execute(db.text(
+                "INSERT INTO friends (user_id, friend_id, status, pair_low, pair_high) VALUES (2, 1, 'Pending', 1, 2)"
+            ))
+        db.session.rollback()
+
+
+def test_migrate_twice_is_a_no_op(baseline_app, capsys):
+    with baseline_app.app_context():
+        migrate()
+        capsys.readouterr()
+        migrate()
+        assert "Applied migration" not in capsys.readouterr().out
+        assert rows("SELECT count(*) FROM schema_migrations") == [(len(MIGRATIONS),)]
+
+
+def test_migrated_baseline_database_uses_indexes(baseline_app):
+    with baseline_app.app_context():
+        migrate()
+        results = check_query_plans()
+    assert [(name, plan) for name, uses_index, plan in results if not uses_index] == []
+
+
+@pytest.mark.parametrize("name", [name for name, _, _ in plan_checks()])
+def test_hot_query_uses_its_index(name):
+    with service.app.app_context():
+        results = {n: (uses_index, plan) for n, uses_index, plan in check_query_plans()}
+    uses_index, plan = results[name]
+    assert uses_index, plan
@@ -0,0 +1,106 @@
+import pytest
+from sqlalchemy import event
+
+import app as service
+from db import db, User, Course, Session, Friend, Major, Interest
+
+# Every route that serializes relationships must issue the same number of
+# queries for few rows and for many. {user}, {course} and {session} are the
+# ids of the first seeded rows
+ROUTES = [
+    "/users/",
+    "/users/?limit=500",
+    "/users/?format=ndjson",
+    "/users/{user}/",
+    "/users/{user}/friend/",
+    "/users/{user}/schedule/",
+    "/courses/{course}/",
+    "/session/{session}/",
+]
+SEEDED = {}
+
+def seed(start, count):
+    """
+    Adds count users enrolled in the first seeded session and a new session
+    of the seeded course, befriended by the first seeded user, with a major
+    and two interests each. The first user also joins the new session, so
+    its schedule grows too
+    """
+    with service.app.app_context():
+        course = Course.query.filter_by(code="CS2110").first()
+        if course is None:
+            course = Course(code="CS2110", name="Object-Oriented Programming and Data Structures")
+            db.session.add(course)
+            db.session.flush()
+        session = Session(course_id=course.id, class_number=str(1000 + start), name="LEC%03d" % start, time="MWF")
+        db.session.add(session)
+        db.session.flush()
+        SEEDED.setdefault("course", course.id)
+        SEEDED.setdefault("session", session.id)
+        first = db.session.get(Session, SEEDED["session"])
+        majors = Major.query.all()
+        interests = Interest.query.all()
+        users = []
+        for i in range(start, start + count):
+            user = User(google_id="g%d" % i, name="u%d" % i, email="u%d@example.com" % i)
+            user.major = majors[i % len(majors)]
+            user.interests = [interests[i % len(interests)], interests[(i + 1) % len(interests)]]
+            user.sessions = [first, session] if session is not first else [first]
+            users.append(user)
+        db.session.add_all(users)
+        db.session.flush()
+        SEEDED.setdefault("user", users[0].id)
+        owner = db.session.get(User, SEEDED["user"])
+        if session not in owner.sessions:
+            owner.sessions.append(session)
+        for user in users:
+            if user.id != owner.id:
+                db.session.add(Friend(user_id=owner.id, friend_id=user.id, status="Accepted"))
+        db.session.commit()
+        # Rows were written behind the in-memory indexes' back
+        service.candidate_index.build()
+        service.friend_graph.build()
+
+
+def count_queries(client, url):
+    """
+    Returns the number of statements the app runs to answer a GET of url
+    """
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with service.app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        service.catalog_cache.bump()
+        response = client.get(url)
+        response.get_data()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert response.status_code == 200, url
+    return len(statements)
+
+
+@pytest.fixture(scope="module")
+def counts():
+    """
+    Query counts of every route with 5 users and with 40 users
+    """
+    service.list_of_majors()
+    service.list_of_interests()
+    # Serve the catalog routes from the ORM rather than the snapshot
+    service.catalog_snapshot.path = service.catalog_snapshot.resolve() + ".missing"
+    service.catalog_snapshot.view = None
+    client = service.app.test_client()
+    seed(1, 5)
+    small = {url: count_queries(client, url.format(**SEEDED)) for url in ROUTES}
+    seed(6, 35)
+    large = {url: count_queries(client, url.format(**SEEDED)) for url in ROUTES}
+    return small, large
+
+
+@pytest.mark.parametrize("url", ROUTES)
+def test_query_count_does_not_grow_with_rows(counts, url):
+    small, large = counts
+    assert small[url] == large[url]